@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Cache of the decoded sensor data as NumPy arrays, shared by all the tools
+
+The first time a message type of a file is requested (see decode_columns in
+columns.py), only the messages of that type are decoded and their columns
+are saved as .npy files, sorted on epoch, in a directory named by the hash of
+the file's contents, listed in its manifest.json. Later, the arrays are
+memory mapped rather than parsing the protobuf messages again, and other
+message types are added when first requested. Fields that are 0 in every
+message of a type aren't saved.
+
+The index.json in the cache directory maps each file's path, size, and
+modification time to its hash, so the file only needs to be hashed again if
+it changes (or when a copy is first used). When the cache is larger than its
+size limit, the least recently used entries are deleted.
+
+Entries are also named by a hash of the SensorData fields and the format of
+the cache (SCHEMA), so after watch-data.proto changes, files are decoded
+again rather than using arrays saved without the new fields.
+
+Environment variables:
+ - WATCH_CACHE_DIR: cache directory (default: ~/.cache/watch-protobuf)
+ - WATCH_CACHE_SIZE: size limit in MiB (default: 10240)
+ - WATCH_NO_CACHE: if set to 1, always decode without the cache
+
+    ./cache.py info
+    ./cache.py clear
+"""
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import numpy as np
+
+from columns import get_columns, get_dtype
+from decoding import decode
+from watch_data_pb2 import SensorData
+
+# Fields with one value per message, other than the epoch
+VALUE_FIELDS = [field.name for field in SensorData.DESCRIPTOR.fields
+    if field.name not in ["epoch", "message_type"]]
+
+# Default size limit in MiB
+DEFAULT_SIZE = 10240
+
+# Increase if how the arrays are saved changes
+FORMAT_VERSION = 1
+
+# Hash of the fields and format, so entries from before either changed
+# aren't used
+SCHEMA = hashlib.blake2b(json.dumps([FORMAT_VERSION, [[field.name,
+    field.number, field.type] for field in SensorData.DESCRIPTOR.fields]])
+    .encode(), digest_size=4).hexdigest()
+
+
+def get_cache_dir():
+    """ Get the cache directory from the environment """
+    if os.environ.get("WATCH_CACHE_DIR"):
+        return os.environ["WATCH_CACHE_DIR"]
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") \
+        or os.path.join(os.path.expanduser("~"), ".cache")
+
+    return os.path.join(cache_home, "watch-protobuf")
+
+
+def get_size_limit():
+    """ Get the cache size limit in bytes from the environment """
+    return int(float(os.environ.get("WATCH_CACHE_SIZE", DEFAULT_SIZE))
+        * 1024 * 1024)
+
+
+def cache_enabled():
+    """ Whether to use the cache, per the environment """
+    return os.environ.get("WATCH_NO_CACHE", "0") != "1"
+
+
+def file_hash(filename, block_size=1 << 22):
+    """ Hash the contents of a file """
+    digest = hashlib.blake2b(digest_size=20)
+
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def load_manifest(filename):
+    """ Load an entry's manifest, or None if there isn't one """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_json(data, filename):
+    """ Write JSON to a temporary file, then rename it, so readers never see
+    a partially-written file """
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename),
+        suffix=".tmp")
+
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+
+    os.replace(tmp_filename, filename)
+
+
+class DecodeCache:
+    """ Decode files into cached columns, or load them if already cached """
+    def __init__(self, cache_dir=None, size_limit=None):
+        self.cache_dir = cache_dir if cache_dir is not None \
+            else get_cache_dir()
+        self.size_limit = size_limit if size_limit is not None \
+            else get_size_limit()
+        self.index_filename = os.path.join(self.cache_dir, "index.json")
+        self.lock_filename = os.path.join(self.cache_dir, "index.lock")
+
+    @contextlib.contextmanager
+    def locked(self):
+        """ Lock the index and manifests, since other processes, e.g. jobs of
+        runner.py, may use the cache at the same time """
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        with open(self.lock_filename, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def load_index(self):
+        """ Load the path: {size, mtime_ns, hash} index """
+        try:
+            with open(self.index_filename) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get_hash(self, path):
+        """ Get the hash of a file, from the index if it didn't change """
+        stat = os.stat(path)
+        known = self.load_index().get(path)
+
+        if known is not None and known["size"] == stat.st_size \
+                and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["hash"]
+
+        digest = file_hash(path)
+
+        with self.locked():
+            index = self.load_index()
+            index[path] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "hash": digest,
+            }
+            write_json(index, self.index_filename)
+
+        return digest
+
+    def get_entry(self, filename, message_type, fields=()):
+        """ Get the cache entry of a file, decoding the messages of the
+        message type first if not cached, or if cached without the given
+        fields
+
+        Returns the entry's directory and manifest. """
+        path = os.path.abspath(filename)
+        digest = self.get_hash(path)
+        name = digest+"-"+SCHEMA
+        entry_dir = os.path.join(self.cache_dir, name)
+        manifest_filename = os.path.join(entry_dir, "manifest.json")
+
+        with self.locked():
+            manifest = load_manifest(manifest_filename)
+
+            if manifest is not None and (manifest.get("schema") != SCHEMA
+                    or any(field not in manifest["fields"]
+                        for field in fields)):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                manifest = None
+
+            if manifest is not None:
+                # Mark as recently used for evicting the least recently used
+                os.utime(manifest_filename)
+
+        if manifest is None or str(message_type) not in manifest["types"]:
+            manifest = self.build(path, digest, entry_dir, message_type)
+            self.evict(keep=name)
+
+        return entry_dir, manifest
+
+    def build(self, filename, digest, entry_dir, message_type):
+        """ Decode the messages of one message type from a file, save their
+        columns, and add them to the entry's manifest, returning it """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix=".build-")
+        messages = decode(filename, SensorData, {message_type})
+        columns = get_columns(messages, message_type, VALUE_FIELDS)
+        saved = []
+        size = 0
+
+        for field, values in columns.items():
+            # Skip fields not used by this message type
+            if field != "epoch" and not values.any():
+                continue
+
+            np.save(os.path.join(tmp_dir, field+".npy"), values)
+            size += values.nbytes
+            saved.append(field)
+
+        manifest_filename = os.path.join(entry_dir, "manifest.json")
+
+        with self.locked():
+            manifest = load_manifest(manifest_filename) or {
+                "source": filename,
+                "hash": digest,
+                "schema": SCHEMA,
+                "fields": VALUE_FIELDS,
+                "types": {},
+                "bytes": 0,
+            }
+
+            # Another process may have cached the same message type at the
+            # same time
+            if str(message_type) in manifest["types"]:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            else:
+                type_dir = os.path.join(entry_dir, str(message_type))
+                os.makedirs(entry_dir, exist_ok=True)
+                shutil.rmtree(type_dir, ignore_errors=True)
+                os.rename(tmp_dir, type_dir)
+                manifest["types"][str(message_type)] = {
+                    "rows": len(columns["epoch"]),
+                    "fields": saved,
+                }
+                manifest["bytes"] += size
+                write_json(manifest, manifest_filename)
+
+        return manifest
+
+    def load_columns(self, filename, message_type, fields):
+        """ Get the given fields of one message type as memory-mapped arrays
+        sorted on epoch, the same as get_columns """
+        for field in fields:
+            if field not in VALUE_FIELDS:
+                raise KeyError("no field "+field+" in SensorData")
+
+        while True:
+            entry_dir, manifest = self.get_entry(filename, message_type,
+                fields)
+
+            info = manifest["types"][str(message_type)]
+            type_dir = os.path.join(entry_dir, str(message_type))
+            columns = {}
+
+            # Memory map while locked, so another process can't evict the
+            # entry meanwhile; once mapped, deleting the files is fine
+            try:
+                with self.locked():
+                    for field in ["epoch"] + list(fields):
+                        if field in info["fields"]:
+                            columns[field] = np.load(os.path.join(type_dir,
+                                field+".npy"), mmap_mode="r")
+                        else:
+                            columns[field] = np.zeros(info["rows"],
+                                dtype=get_dtype(SensorData, field))
+            except FileNotFoundError:
+                # Evicted after we got it, so cache it again
+                continue
+
+            return columns
+
+    def get_entries(self):
+        """ Get the (directory, manifest filename) of each entry """
+        entries = []
+
+        if not os.path.exists(self.cache_dir):
+            return entries
+
+        for name in os.listdir(self.cache_dir):
+            # Skip anything being written, e.g. by an older version
+            if name.startswith("."):
+                continue
+
+            manifest_filename = os.path.join(self.cache_dir, name,
+                "manifest.json")
+
+            if os.path.exists(manifest_filename):
+                entries.append((os.path.join(self.cache_dir, name),
+                    manifest_filename))
+
+        return entries
+
+    def evict(self, keep=None):
+        """ Delete the least recently used entries, other than keep, until
+        the cache is within its size limit """
+        with self.locked():
+            entries = []
+
+            for entry_dir, manifest_filename in self.get_entries():
+                with open(manifest_filename) as f:
+                    size = json.load(f)["bytes"]
+
+                entries.append((os.path.getmtime(manifest_filename), size,
+                    entry_dir))
+
+            total = sum(size for _, size, _ in entries)
+
+            for _, size, entry_dir in sorted(entries):
+                if total <= self.size_limit:
+                    break
+
+                if os.path.basename(entry_dir) != keep:
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    total -= size
+
+    def clear(self):
+        """ Delete all the entries and the index """
+        with self.locked():
+            for entry_dir, _ in self.get_entries():
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+            if os.path.exists(self.index_filename):
+                os.remove(self.index_filename)
+
+    def info(self):
+        """ Get the directory, size limit, and size and source of each entry """
+        entries = []
+
+        for entry_dir, manifest_filename in self.get_entries():
+            with open(manifest_filename) as f:
+                manifest = json.load(f)
+
+            entries.append({
+                "hash": manifest["hash"],
+                "source": manifest["source"],
+                "bytes": manifest["bytes"],
+                "last_used": os.path.getmtime(manifest_filename),
+            })
+
+        return {
+            "cache_dir": self.cache_dir,
+            "size_limit": self.size_limit,
+            "bytes": sum(entry["bytes"] for entry in entries),
+            "entries": sorted(entries, key=lambda entry: entry["last_used"]),
+        }
+
+
+def load_columns(filename, message_type, fields):
+    """ Get the columns from the cache in the default directory (see
+    DecodeCache.load_columns) """
+    return DecodeCache().load_columns(filename, message_type, fields)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["info", "clear"],
+        help="show what's cached, or delete it all")
+    args = parser.parse_args(argv)
+
+    cache = DecodeCache()
+
+    if args.command == "info":
+        print(json.dumps(cache.info(), indent=2))
+    else:
+        cache.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Extract the values of decoded messages as NumPy arrays, one per field
+"""
+import os
+import numpy as np
+
+from operator import attrgetter
+from google.protobuf.descriptor import FieldDescriptor
+
+from decoding import decode
+from watch_data_pb2 import SensorData, PromptResponse
+
+# Fields of each message type, in the order we use them as channels
+ACCEL_FIELDS = ["raw_accel_x", "raw_accel_y", "raw_accel_z"]
+MOTION_FIELDS = [
+    "user_accel_x", "user_accel_y", "user_accel_z",
+    "grav_x", "grav_y", "grav_z",
+    "rot_rate_x", "rot_rate_y", "rot_rate_z",
+    "roll", "pitch", "yaw",
+]
+LOCATION_FIELDS = [
+    "latitude", "longitude", "altitude", "horiz_acc", "vert_acc",
+    "course", "speed", "floor",
+]
+BATTERY_FIELDS = ["bat_level", "bat_state"]
+
+
+def get_dtype(message_type, field_name):
+    """ Get the NumPy dtype matching the protobuf type of a field """
+    field = message_type.DESCRIPTOR.fields_by_name[field_name]
+
+    if field.type == FieldDescriptor.TYPE_DOUBLE:
+        return np.float64
+    elif field.type == FieldDescriptor.TYPE_FLOAT:
+        return np.float32
+    elif field.type == FieldDescriptor.TYPE_STRING:
+        return np.str_
+    else:
+        return np.int32
+
+
+def get_columns(messages, message_type, fields):
+    """ Get the epoch and the given fields of all SensorData messages of one
+    message type, sorted on epoch
+
+    Returns a dictionary of field name to a NumPy array, with the epochs
+    in the "epoch" array. """
+    selected = [msg for msg in messages if msg.message_type == message_type]
+    return _to_columns(selected, SensorData, fields)
+
+
+def decode_columns(filename, message_type, fields, cache=True):
+    """ Decode only the SensorData messages of one message type from a file,
+    getting only the given fields as arrays (see get_columns)
+
+    Unless cache is False or WATCH_NO_CACHE=1, the arrays of the message
+    type are cached the first time and memory mapped from then on (see
+    cache.py). The arrays are then read-only. """
+    # Imported here since cache.py uses get_columns
+    from cache import cache_enabled, load_columns
+
+    if cache and cache_enabled() and filename != "-":
+        return load_columns(filename, message_type, fields)
+
+    messages = decode(filename, SensorData, {message_type})
+    return get_columns(messages, message_type, fields)
+
+
+def get_labels(messages):
+    """ Get the epochs and activity labels of the PromptResponse messages,
+    sorted on epoch """
+    selected = [msg for msg in messages
+        if msg.prompt_type == PromptResponse.PROMPT_TYPE_ACTIVITY_QUERY]
+    columns = _to_columns(selected, PromptResponse, ["user_activity_label"])
+
+    return columns["epoch"], columns["user_activity_label"]
+
+
+def _to_columns(messages, message_type, fields):
+    """ Get the epoch and fields of messages as arrays, sorted on epoch """
+    fields = ["epoch"] + list(fields)
+    getter = attrgetter(*fields)
+
+    # attrgetter returns a value rather than a tuple for a single field
+    if len(fields) == 1:
+        rows = [(getter(msg),) for msg in messages]
+    else:
+        rows = [getter(msg) for msg in messages]
+
+    # Transpose rows into one tuple of values per field
+    values = list(zip(*rows)) if len(rows) > 0 else [()]*len(fields)
+
+    columns = {}
+
+    for name, column in zip(fields, values):
+        columns[name] = np.array(column, dtype=get_dtype(message_type, name))
+
+    # Sort since when saving to a file on the watch, they may be out of order
+    order = np.argsort(columns["epoch"], kind="stable")
+
+    return {name: values[order] for name, values in columns.items()}
+
+
+def save_arrays(arrays, output):
+    """ Save to one .npz file if the output ends in .npz, otherwise to a
+    directory of .npy files """
+    if output.endswith(".npz"):
+        np.savez(output, **arrays)
+    else:
+        os.makedirs(output, exist_ok=True)
+
+        for name, values in arrays.items():
+            np.save(os.path.join(output, name+".npy"), values)
@@ -2,43 +2,64 @@
 """
 Decode response protobuf into JSON
 """
-import os
-import sys
-import json
+import argparse
 
 from datetime import datetime
 
-from decoding import decode, write_messages
+from decoding import decode, write_messages, add_file_arguments, \
+    get_file_pairs, print_dropped
+from serializer import Serializer
+from streaming import write_ndjson
 from watch_data_pb2 import PromptResponse
 
 
-def msg_to_json(msg):
-    """ Create JSON from message """
-    data = {}
+SERIALIZER = Serializer(PromptResponse,
+    header=[("epoch", "epoch")],
+    layouts={"PROMPT_TYPE_ACTIVITY_QUERY": [("label", "user_activity_label")]},
+    type_field="prompt_type",
+    formatters={"epoch": lambda epoch: str(datetime.fromtimestamp(epoch))})
 
-    data["epoch"] = str(datetime.fromtimestamp(msg.epoch))
 
-    if msg.prompt_type == PromptResponse.PROMPT_TYPE_ACTIVITY_QUERY:
-        data["label"] = msg.user_activity_label
-    else:
-        raise NotImplementedError("found unknown message type")
+def msg_to_json(msg):
+    """ Create JSON from message """
+    return SERIALIZER.to_json(msg)
 
-    return json.dumps(data)
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    add_file_arguments(parser, ".json")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+        help="pipeline reading, parsing and writing, converting to JSON in "
+        "this many processes")
+    parser.add_argument("--dedup", action="store_true",
+        help="drop duplicate messages, e.g. if the same file was downloaded "
+        "twice, and report how many")
+    parser.add_argument("--ndjson", action="store_true",
+        help="stream one JSON object per line as messages are read")
+    parser.add_argument("--order", default="sorted",
+        choices=["sorted", "arrival"],
+        help="with --ndjson, sort on epoch with a bounded buffer or output "
+        "in the order read")
+    parser.add_argument("--sort-window", type=float, default=60.0,
+        help="with --ndjson, seconds of messages to buffer for sorting")
+    args = parser.parse_args(argv)
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: ./decode_responses.py input.pb output.json")
-        exit(1)
+    for input_fn, output_fn in get_file_pairs(args, ".json"):
+        if args.ndjson:
+            dropped = write_ndjson(input_fn, PromptResponse, msg_to_json,
+                output_fn, args.order, args.sort_window, args.dedup)
+        elif args.workers is not None:
+            # Only import multiprocessing, etc. if needed
+            from pipeline import write_messages_pipelined
+            dropped = write_messages_pipelined(input_fn, PromptResponse,
+                msg_to_json, output_fn, args.workers, dedup=args.dedup)
+        else:
+            dropped = write_messages(decode(input_fn, PromptResponse),
+                SERIALIZER.to_json, output_fn, args.dedup)
 
-    input_fn = sys.argv[1]
-    output_fn = sys.argv[2]
+        if args.dedup:
+            print_dropped(dropped)
 
-    if not os.path.exists(input_fn):
-        print("Error: input file does not exist:", input_fn)
-        exit(1)
-    if os.path.exists(output_fn):
-        print("Error: output file exists:", output_fn)
-        exit(1)
 
-    write_messages(decode(input_fn, PromptResponse), msg_to_json, output_fn)
+if __name__ == "__main__":
+    main()
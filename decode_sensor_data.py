@@ -2,113 +2,117 @@
 """
 Decode protobuf into JSON
 """
-import os
-import sys
-import json
+import argparse
 
 from datetime import datetime
 
-from decoding import decode, write_messages, get_enum_str
+from decoding import decode, write_messages, add_file_arguments, \
+    get_file_pairs, print_dropped
+from serializer import Serializer
+from streaming import write_ndjson
 from watch_data_pb2 import SensorData
 
 
-def msg_to_json(msg):
-    """ Create JSON from message """
-    data = {}
-
-    data["epoch"] = str(datetime.fromtimestamp(msg.epoch))
-    data["message_type"] = get_enum_str(msg, "message_type", msg.message_type)
+# Keys and nested objects of each message type, after the epoch and type
+XYZ = ["x", "y", "z"]
+LAYOUTS = {
+    "MESSAGE_TYPE_ACCELEROMETER": [
+        ("raw_acceleration", [(axis, "raw_accel_"+axis) for axis in XYZ]),
+    ],
+    "MESSAGE_TYPE_DEVICE_MOTION": [
+        ("attitude", [("roll", "roll"), ("pitch", "pitch"), ("yaw", "yaw")]),
+        ("rotation_rate", [(axis, "rot_rate_"+axis) for axis in XYZ]),
+        ("user_acceleration", [(axis, "user_accel_"+axis) for axis in XYZ]),
+        ("gravity", [(axis, "grav_"+axis) for axis in XYZ]),
+        ("heading", "heading"),
+        ("magnetic_field", [("calibration_accuracy", "mag_calibration_acc")]
+            + [(axis, "mag_"+axis) for axis in XYZ]),
+    ],
+    "MESSAGE_TYPE_LOCATION": [
+        ("longitude", "longitude"),
+        ("latitude", "latitude"),
+        ("horizontal_accuracy", "horiz_acc"),
+        ("altitude", "altitude"),
+        ("vertical_accuracy", "vert_acc"),
+        ("course", "course"),
+        ("speed", "speed"),
+        ("floor", "floor"),
+    ],
+    "MESSAGE_TYPE_BATTERY": [
+        ("bat_level", "bat_level"),
+        ("bat_state", "bat_state"),
+    ],
+}
 
-    if msg.message_type == SensorData.MESSAGE_TYPE_ACCELEROMETER:
-        data["raw_acceleration"] = {
-            "x": msg.raw_accel_x,
-            "y": msg.raw_accel_y,
-            "z": msg.raw_accel_z,
-        }
-    elif msg.message_type == SensorData.MESSAGE_TYPE_DEVICE_MOTION:
-        data["attitude"] = {
-            "roll": msg.roll,
-            "pitch": msg.pitch,
-            "yaw": msg.yaw,
-        }
-        data["rotation_rate"] = {
-            "x": msg.rot_rate_x,
-            "y": msg.rot_rate_y,
-            "z": msg.rot_rate_z,
-        }
-        data["user_acceleration"] = {
-            "x": msg.user_accel_x,
-            "y": msg.user_accel_y,
-            "z": msg.user_accel_z,
-        }
-        data["gravity"] = {
-            "x": msg.grav_x,
-            "y": msg.grav_y,
-            "z": msg.grav_z,
-        }
-        data["heading"] = msg.heading if msg.heading != 0.0 else None
+# Note: default values for numeric types are 0 with proto3, so we can't
+# differentiate 0.0 from unspecified. However, it's highly unlikely that
+# multiple values are exactly 0.0, so we'll use that to determine if the
+# values should be valid. Field: null if these fields are all 0.
+HORIZONTAL = ["longitude", "latitude", "horiz_acc"]
+VERTICAL = ["altitude", "vert_acc"]
+NULL_WHEN_ZERO = {
+    "heading": ["heading"],
+    "mag_x": ["mag_calibration_acc"],
+    "mag_y": ["mag_calibration_acc"],
+    "mag_z": ["mag_calibration_acc"],
+    "longitude": HORIZONTAL,
+    "latitude": HORIZONTAL,
+    "horiz_acc": HORIZONTAL,
+    "altitude": VERTICAL,
+    "vert_acc": VERTICAL,
+    "course": ["course"],
+    "speed": ["speed"],
+    "floor": ["floor"],
+}
 
-        if msg.mag_calibration_acc == SensorData.MAG_CALIBRATION_UNSPECIFIED:
-            data["magnetic_field"] = {
-                "calibration_accuracy":
-                    get_enum_str(msg, "mag_calibration_acc", SensorData.MAG_CALIBRATION_UNCALIBRATED),
-                "x": None,
-                "y": None,
-                "z": None,
-            }
-        else:
-            data["magnetic_field"] = {
-                "calibration_accuracy": get_enum_str(msg, "mag_calibration_acc", msg.mag_calibration_acc),
-                "x": msg.mag_x,
-                "y": msg.mag_y,
-                "z": msg.mag_z,
-            }
-    elif msg.message_type == SensorData.MESSAGE_TYPE_LOCATION:
-        # Note: default values for numeric types are 0 with proto3, so we can't
-        # differentiate 0.0 from unspecified. However, it's highly unlikely that
-        # multiple values are exactly 0.0, so we'll use that to determine if
-        # the values should be valid.
-        if msg.longitude == 0.0 and msg.latitude == 0.0 and msg.horiz_acc == 0.0:
-            data["longitude"] = None
-            data["latitude"] = None
-            data["horizontal_accuracy"] = None
-        else:
-            data["longitude"] = msg.longitude
-            data["latitude"] = msg.latitude
-            data["horizontal_accuracy"] = msg.horiz_acc
+SERIALIZER = Serializer(SensorData,
+    header=[("epoch", "epoch"), ("message_type", "message_type")],
+    layouts=LAYOUTS, type_field="message_type",
+    null_when_zero=NULL_WHEN_ZERO,
+    enum_zero_as={"mag_calibration_acc": "MAG_CALIBRATION_UNCALIBRATED"},
+    formatters={"epoch": lambda epoch: str(datetime.fromtimestamp(epoch))})
 
-        if msg.altitude == 0.0 and msg.vert_acc == 0.0:
-            data["altitude"] = None
-            data["vertical_accuracy"] = None
-        else:
-            data["altitude"] = msg.altitude
-            data["vertical_accuracy"] = msg.vert_acc
 
-        data["course"] = msg.course if msg.course != 0.0 else None
-        data["speed"] = msg.speed if msg.speed != 0.0 else None
-        data["floor"] = msg.floor if msg.floor != 0 else None
-    elif msg.message_type == SensorData.MESSAGE_TYPE_BATTERY:
-        data["bat_level"] = msg.bat_level
-        data["bat_state"] = get_enum_str(msg, "bat_state", msg.bat_state)
-    else:
-        raise NotImplementedError("found unknown message type")
+def msg_to_json(msg):
+    """ Create JSON from message """
+    return SERIALIZER.to_json(msg)
 
-    return json.dumps(data)
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    add_file_arguments(parser, ".json")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+        help="pipeline reading, parsing and writing, converting to JSON in "
+        "this many processes")
+    parser.add_argument("--dedup", action="store_true",
+        help="drop duplicate messages, e.g. if the same file was downloaded "
+        "twice, and report how many")
+    parser.add_argument("--ndjson", action="store_true",
+        help="stream one JSON object per line as messages are read")
+    parser.add_argument("--order", default="sorted",
+        choices=["sorted", "arrival"],
+        help="with --ndjson, sort on epoch with a bounded buffer or output "
+        "in the order read")
+    parser.add_argument("--sort-window", type=float, default=60.0,
+        help="with --ndjson, seconds of messages to buffer for sorting")
+    args = parser.parse_args(argv)
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: ./decode_sensor_data.py input.pb output.json")
-        exit(1)
+    for input_fn, output_fn in get_file_pairs(args, ".json"):
+        if args.ndjson:
+            dropped = write_ndjson(input_fn, SensorData, msg_to_json,
+                output_fn, args.order, args.sort_window, args.dedup)
+        elif args.workers is not None:
+            # Only import multiprocessing, etc. if needed
+            from pipeline import write_messages_pipelined
+            dropped = write_messages_pipelined(input_fn, SensorData,
+                msg_to_json, output_fn, args.workers, dedup=args.dedup)
+        else:
+            dropped = write_messages(decode(input_fn, SensorData),
+                SERIALIZER.to_json, output_fn, args.dedup)
 
-    input_fn = sys.argv[1]
-    output_fn = sys.argv[2]
+        if args.dedup:
+            print_dropped(dropped)
 
-    if not os.path.exists(input_fn):
-        print("Error: input file does not exist:", input_fn)
-        exit(1)
-    if os.path.exists(output_fn):
-        print("Error: output file exists:", output_fn)
-        exit(1)
 
-    write_messages(decode(input_fn, SensorData), msg_to_json, output_fn)
+if __name__ == "__main__":
+    main()
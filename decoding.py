@@ -1,50 +1,269 @@
 """
 Shared code for both decoding sensor data and responses
 """
+import os
+import sys
+import struct
 
+from collections import deque
 
-def decode(filename, message_type):
-    """ Decode protobuf messages from file """
-    messages = []
+# Little-endian double, e.g. the epoch
+DOUBLE = struct.Struct("<d")
+
+
+def open_file(filename, mode="r"):
+    """ Open a file, or stdin/stdout if the filename is "-" """
+    if filename == "-":
+        stream = sys.stdin if "r" in mode else sys.stdout
+        stream.flush()
+        return open(stream.fileno(), mode, closefd=False)
+
+    return open(filename, mode)
+
+
+def split_frames(buf, eof=False):
+    """ Split bytes into size-prefixed messages, returning a list of the
+    bytes of each message and the bytes left over for the next call
+
+    At the end of the file, a truncated last message is returned as is. """
+    pos = 0
+    end = len(buf)
+    frames = []
+
+    while pos + 2 <= end:
+        # Get size of message (little endian), then that many bytes
+        start = pos + 2
+        pos = start + (buf[pos] | (buf[pos+1] << 8))
+
+        # Wait for more bytes if we don't have all of it yet
+        if pos > end and not eof:
+            pos = start - 2
+            break
+
+        frames.append(buf[start:pos])
+
+    return frames, buf[pos:]
+
+
+def read_frame_blocks(f, block_size=1 << 20):
+    """ Read size-prefixed messages from a file, yielding a list of the bytes
+    of each message for each block read
+
+    Reads in large blocks rather than two reads per message, but if reading
+    from a pipe, yields whatever is available rather than waiting for a full
+    block. """
+    read = getattr(f, "read1", f.read)
+    buf = b""
+    eof = False
 
-    with open(filename, "rb") as f:
-        while True:
-            # Get size of message, then read that many bytes
-            size = f.read(2)
+    while not eof:
+        block = read(block_size)
+        eof = block == b""
+        frames, buf = split_frames(buf+block, eof)
 
-            if size == b"":  # eof
-                break
+        if len(frames) > 0:
+            yield frames
 
-            size = int.from_bytes(size, "little")
-            data = f.read(size)
 
-            # Create message from read bytes
-            msg = message_type()
-            msg.ParseFromString(data)
-            messages.append(msg)
+def read_frames(f, block_size=1 << 20):
+    """ Read size-prefixed messages from a file, yielding the bytes of each """
+    for frames in read_frame_blocks(f, block_size):
+        yield from frames
+
+
+def decode(filename, message_type, message_types=None):
+    """ Decode protobuf messages from file
+
+    If message_types is given, only decode the SensorData messages with those
+    message_type values, skipping the others without parsing them. """
+    messages = []
+
+    with open_file(filename, "rb") as f:
+        if message_types is None:
+            for data in read_frames(f):
+                # Create message from read bytes
+                msg = message_type()
+                msg.ParseFromString(data)
+                messages.append(msg)
+        else:
+            for data in read_frames(f):
+                if peek_message_type(data, message_type) in message_types:
+                    msg = message_type()
+                    msg.ParseFromString(data)
+                    messages.append(msg)
 
     return messages
 
 
-def write_messages(messages, msg_to_json_fn, output_filename):
-    """ Sort messages on timestamp, convert to JSON and write to disk """
+def peek_epoch(data, message_type):
+    """ Get the epoch of a message without parsing all of it
+
+    Both SensorData and PromptResponse have the epoch as field 1, a double.
+    Fields are serialized in order, so it's first unless it's 0.0 and thus
+    omitted, in which case we fall back to parsing the message. """
+    if len(data) >= 9 and data[0] == 0x09:  # field 1, 64-bit wire type
+        return DOUBLE.unpack_from(data, 1)[0]
+
+    return message_type.FromString(data).epoch
+
+
+def peek_message_type(data, message_type):
+    """ Get the message_type of a SensorData message without parsing all of it
+
+    The message_type is field 3, a varint, after the epoch. If the epoch is
+    0.0 or the message type doesn't fit in one byte, we fall back to parsing
+    the message. """
+    # field 1, 64-bit wire type; then field 3, varint wire type
+    if len(data) >= 11 and data[0] == 0x09 and data[9] == 0x18 \
+            and data[10] < 0x80:
+        return data[10]
+
+    return message_type.FromString(data).message_type
+
+
+class Deduplicator:
+    """ Find duplicate messages, e.g. from downloading the same file from the
+    watch twice, only remembering the last window seconds of messages
+
+    Messages sorted on epoch have duplicates next to each other, so the
+    default window of 0 is enough. Otherwise, the window must be as long as
+    messages may be out of order. Messages are only compared if they have the
+    same epoch. """
+    def __init__(self, window=0.0):
+        self.window = window
+        self.dropped = 0
+        self.recent = deque()  # epochs in the order first seen
+        self.by_epoch = {}  # epoch: list of messages (or bytes) seen
+
+    def is_duplicate(self, epoch, data):
+        """ Check if we've seen this message, data being the message or its
+        bytes, remembering it if not """
+        # Forget messages older than the window
+        while len(self.recent) > 0 and self.recent[0] < epoch - self.window:
+            del self.by_epoch[self.recent.popleft()]
+
+        seen = self.by_epoch.get(epoch)
+
+        if seen is None:
+            self.by_epoch[epoch] = [data]
+            self.recent.append(epoch)
+        elif data in seen:
+            self.dropped += 1
+            return True
+        else:
+            seen.append(data)
+
+        return False
+
+
+def drop_duplicates(messages):
+    """ Drop duplicate messages from a list sorted on epoch, returning the
+    number dropped """
+    deduplicator = Deduplicator()
+    messages[:] = [msg for msg in messages
+        if not deduplicator.is_duplicate(msg.epoch, msg)]
+
+    return deduplicator.dropped
+
+
+def print_dropped(dropped):
+    """ Report the number of duplicate messages dropped """
+    print("Dropped", dropped, "duplicate messages", file=sys.stderr)
+
+
+def write_messages(messages, msg_to_json_fn, output_filename, dedup=False,
+        batch_size=4096):
+    """ Sort messages on timestamp, convert to JSON and write to disk,
+    batch_size messages at a time
+
+    If dedup, drop duplicate messages, returning the number dropped. """
     # Sort since when saving to a file on the watch, they may be out of order
     messages.sort(key=lambda x: x.epoch)
+    dropped = drop_duplicates(messages) if dedup else 0
 
     # Output JSON
-    with open(output_filename, "w") as f:
-        f.write("[")
+    try:
+        with open_file(output_filename, "w") as f:
+            f.write("[")
 
-        for i, msg in enumerate(messages):
-            f.write(msg_to_json_fn(msg))
+            for i in range(0, len(messages), batch_size):
+                # Invalid JSON if we have an extra comma at the end
+                if i != 0:
+                    f.write(",\n")
 
-            # Invalid JSON if we have an extra comma at the end
-            if i != len(messages)-1:
-                f.write(",\n")
+                f.write(",\n".join(map(msg_to_json_fn,
+                    messages[i:i+batch_size])))
 
-        f.write("]\n")
+            f.write("]\n")
+    except BrokenPipeError:
+        # Whatever is reading our output exited, e.g. head, so stop quietly
+        pass
+
+    return dropped
 
 
 def get_enum_str(msg, field_name, enum_int):
     """ Get the human-readable enum value as a string """
     return msg.DESCRIPTOR.fields_by_name[field_name].enum_type.values_by_number[enum_int].name
+
+
+def add_file_arguments(parser, output_extension):
+    """ Add arguments for either one input and output file or many input files
+    and an output directory """
+    parser.add_argument("files", nargs="+",
+        help="input.pb output"+output_extension+", or any number of input "
+        "files with --output-dir; - for stdin/stdout")
+    parser.add_argument("-o", "--output-dir", default=None,
+        help="write each input.pb to input"+output_extension+" in this "
+        "directory")
+
+
+def get_output_names(input_filenames):
+    """ Get a unique name for each input file for naming its output: the
+    filename without the extension, or if some of those are the same, the
+    path relative to the directory they're all in, e.g. "p1_sensor_data" for
+    p1/sensor_data.pb and p2/sensor_data.pb """
+    paths = [os.path.splitext(os.path.abspath(fn))[0] for fn in input_filenames]
+    names = [os.path.basename(path) for path in paths]
+
+    if len(set(names)) != len(names):
+        common = os.path.commonpath([os.path.dirname(path) for path in paths])
+        names = [os.path.relpath(path, common).replace(os.sep, "_")
+            for path in paths]
+
+    return names
+
+
+def get_file_pairs(args, output_extension):
+    """ Get the (input, output) filenames from the arguments, exiting if an
+    input doesn't exist or an output does exist """
+    if args.output_dir is not None:
+        if "-" in args.files:
+            print("Error: give the output file for stdin rather than "
+                "--output-dir")
+            exit(1)
+        if len(set(map(os.path.abspath, args.files))) != len(args.files):
+            print("Error: the same input file is given more than once")
+            exit(1)
+
+        pairs = [(input_fn, os.path.join(args.output_dir,
+            name+output_extension)) for input_fn, name
+            in zip(args.files, get_output_names(args.files))]
+    elif len(args.files) == 2:
+        pairs = [(args.files[0], args.files[1])]
+    else:
+        print("Error: expected input and output files, or --output-dir")
+        exit(1)
+
+    for input_fn, output_fn in pairs:
+        if input_fn != "-" and not os.path.exists(input_fn):
+            print("Error: input file does not exist:", input_fn)
+            exit(1)
+        if output_fn != "-" and os.path.exists(output_fn):
+            print("Error: output file exists:", output_fn)
+            exit(1)
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    return pairs
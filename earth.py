@@ -0,0 +1,108 @@
+"""
+Rotate the device motion acceleration from the device frame into the earth
+frame, all samples at once, and derive channels that don't depend on how the
+watch is worn: vertical acceleration, horizontal magnitude, and magnitude
+
+Attitude convention (CoreMotion, right-handed, radians): starting from the
+reference frame with z pointing up, the device is rotated by yaw about z,
+then pitch about the new x axis, then roll about the new y axis. The
+rotation from the device frame to the reference frame is thus
+
+    R = Rz(yaw) Rx(pitch) Ry(roll)
+
+and a vector v in the device frame is R v in the reference frame, e.g.
+gravity is then (0, 0, -1) g's. The reference frame's x and y are horizontal
+but point in an arbitrary direction, so only the vertical component and the
+horizontal magnitude are meaningful across recordings. Use gravity_error()
+to check this convention on real data.
+"""
+import numpy as np
+
+# Acceleration in the reference frame, z up
+EARTH_FIELDS = ["earth_accel_x", "earth_accel_y", "earth_accel_z"]
+
+# Channels derived from it
+DERIVED_FIELDS = ["vertical_accel", "horizontal_accel", "accel_magnitude"]
+
+
+def rotation_matrices(roll, pitch, yaw):
+    """ Get the (samples, 3, 3) rotation matrices from the device frame to
+    the reference frame, Rz(yaw) Rx(pitch) Ry(roll) multiplied out """
+    cr, sr = np.cos(roll), np.sin(roll)
+    cp, sp = np.cos(pitch), np.sin(pitch)
+    cy, sy = np.cos(yaw), np.sin(yaw)
+
+    matrices = np.empty((len(roll), 3, 3), dtype=np.result_type(roll, pitch,
+        yaw, np.float32))
+    matrices[:, 0, 0] = cy*cr - sy*sp*sr
+    matrices[:, 0, 1] = -sy*cp
+    matrices[:, 0, 2] = cy*sr + sy*sp*cr
+    matrices[:, 1, 0] = sy*cr + cy*sp*sr
+    matrices[:, 1, 1] = cy*cp
+    matrices[:, 1, 2] = sy*sr - cy*sp*cr
+    matrices[:, 2, 0] = -cp*sr
+    matrices[:, 2, 1] = sp
+    matrices[:, 2, 2] = cp*cr
+
+    return matrices
+
+
+def to_earth_frame(vectors, roll, pitch, yaw, chunk_size=1 << 20):
+    """ Rotate (samples, 3) vectors from the device frame into the reference
+    frame, chunk_size samples at a time to limit the memory of the matrices """
+    vectors = np.asarray(vectors)
+    result = np.empty(vectors.shape, dtype=np.result_type(vectors, np.float32))
+
+    for start in range(0, len(vectors), chunk_size):
+        end = start + chunk_size
+        matrices = rotation_matrices(roll[start:end], pitch[start:end],
+            yaw[start:end])
+        result[start:end] = np.einsum("nij,nj->ni", matrices,
+            vectors[start:end])
+
+    return result
+
+
+def derive_channels(earth, user_accel):
+    """ Get the (samples, 3) derived channels, in the order of DERIVED_FIELDS,
+    from the user acceleration in the reference and device frames """
+    # User acceleration already has gravity removed
+    return np.stack([
+        earth[:, 2],
+        np.hypot(earth[:, 0], earth[:, 1]),
+        np.linalg.norm(user_accel, axis=1),
+    ], axis=1)
+
+
+def earth_columns(motion, chunk_size=1 << 20):
+    """ Get the acceleration in the reference frame and the derived channels
+    from device motion columns (see get_columns), as columns with the same
+    epochs """
+    user_accel = np.stack([motion["user_accel_x"], motion["user_accel_y"],
+        motion["user_accel_z"]], axis=1)
+    earth = to_earth_frame(user_accel, motion["roll"], motion["pitch"],
+        motion["yaw"], chunk_size)
+
+    derived = derive_channels(earth, user_accel)
+    columns = {"epoch": motion["epoch"]}
+
+    for i, field in enumerate(EARTH_FIELDS):
+        columns[field] = earth[:, i]
+
+    for i, field in enumerate(DERIVED_FIELDS):
+        columns[field] = derived[:, i]
+
+    return columns
+
+
+def gravity_error(motion, chunk_size=1 << 20):
+    """ Get the angle in radians between gravity rotated into the reference
+    frame and straight down for each sample, which is near 0 if the attitude
+    convention above matches the data """
+    grav = np.stack([motion["grav_x"], motion["grav_y"], motion["grav_z"]],
+        axis=1)
+    earth = to_earth_frame(grav, motion["roll"], motion["pitch"],
+        motion["yaw"], chunk_size)
+    norm = np.maximum(np.linalg.norm(earth, axis=1), np.finfo(np.float32).tiny)
+
+    return np.arccos(np.clip(-earth[:, 2] / norm, -1.0, 1.0))
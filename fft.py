@@ -3,25 +3,42 @@
 Plot spectrograms of the data
 
 See: https://matplotlib.org/3.1.0/api/_as_gen/matplotlib.pyplot.specgram.html
+
+With --batch, render the figures of any number of files to PNG files without
+a GUI, in parallel:
+
+    ./fft.py --batch --output_dir plots/ participant*/sensor_data.pb
+
+Each file is decoded in a worker process into .npy files of each group of
+channels, which the workers rendering the figures then memory map rather
+than having the data pickled and sent to them.
 """
+import os
+import sys
+import shutil
+import tempfile
 import numpy as np
 import matplotlib.pyplot as plt
 
 from absl import app
 from absl import flags
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from matplotlib.animation import FuncAnimation
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
-from decoding import decode
+from decoding import decode, get_output_names
+from earth import DERIVED_FIELDS, to_earth_frame, derive_channels, \
+    earth_columns
 from watch_data_pb2 import SensorData
 
 FLAGS = flags.FLAGS
 
-flags.DEFINE_string("input", None, "Input protobuf file")
+flags.DEFINE_list("input", None, "Input protobuf file, or with --batch, comma-separated files (or list them after the flags)")
+flags.DEFINE_string("pyramid", None, "Instead of --input, plot the decimated data from this pyramid directory (see pyramid.py) at its lower --freq")
 flags.DEFINE_boolean("save", False, "If not animating, save the figures to files")
 flags.DEFINE_boolean("sort", True, "Sort protobuf messages")
 flags.DEFINE_float("freq", 50.0, "Sampling frequency in Hz of accelerometers, etc.")
-flags.DEFINE_enum("animate", "none", ["none", "raw_accel", "user_accel", "grav", "rot_rate", "attitude"], "Animate spectrogram rather than plot, if any other than \"none\"")
+flags.DEFINE_enum("animate", "none", ["none", "raw_accel", "user_accel", "grav", "rot_rate", "attitude", "earth_accel"], "Animate spectrogram rather than plot, if any other than \"none\"")
 flags.DEFINE_integer("nfft", 128, "NFFT for spectrogram, samples per FFT block")
 flags.DEFINE_integer("noverlap", 118, "noverlap for spectrogram, overlap between subsequent windows for FFT")
 flags.DEFINE_integer("animate_start", 0, "Sample to start animation at")
@@ -31,8 +48,35 @@ flags.DEFINE_boolean("psd", True, "Plot the power spectral density spectrogram")
 flags.DEFINE_boolean("magnitude", False, "Plot the magnitude spectrogram")
 flags.DEFINE_boolean("angle", False, "Plot the angle spectrogram")
 flags.DEFINE_boolean("phase", False, "Plot the phase spectrogram")
-
-flags.mark_flag_as_required("input")
+flags.DEFINE_boolean("earth", False, "Also plot the vertical, horizontal, and total user acceleration in the earth frame (see earth.py)")
+flags.DEFINE_boolean("batch", False, "Render the figures of each input file to PNG files in --output_dir in parallel, without a GUI (always sorted)")
+flags.DEFINE_string("output_dir", ".", "With --batch, directory for the figures, named \"<input name> - <title>.png\"")
+flags.DEFINE_integer("workers", None, "With --batch, number of processes (default: number of cores)")
+
+flags.mark_flags_as_mutual_exclusive(["input", "pyramid"])
+
+# Names of the derived channels of earth.py
+EARTH_ACCEL_NAMES = ["vertical", "horizontal", "magnitude"]
+
+# Groups of channels we plot: name, figure title, units, channel names, and
+# the fields of the message type they're from (see columns.py)
+GROUPS = [
+    ("raw_accel", "Raw Acceleration", "g's", ["x", "y", "z"],
+        SensorData.MESSAGE_TYPE_ACCELEROMETER,
+        ["raw_accel_x", "raw_accel_y", "raw_accel_z"]),
+    ("user_accel", "User Acceleration", "g's", ["x", "y", "z"],
+        SensorData.MESSAGE_TYPE_DEVICE_MOTION,
+        ["user_accel_x", "user_accel_y", "user_accel_z"]),
+    ("grav", "Gravity", "g's", ["x", "y", "z"],
+        SensorData.MESSAGE_TYPE_DEVICE_MOTION, ["grav_x", "grav_y", "grav_z"]),
+    ("rot_rate", "Rotation Rates", "rad/s", ["x", "y", "z"],
+        SensorData.MESSAGE_TYPE_DEVICE_MOTION,
+        ["rot_rate_x", "rot_rate_y", "rot_rate_z"]),
+    ("attitude", "Attitude", "rad", ["roll", "pitch", "yaw"],
+        SensorData.MESSAGE_TYPE_DEVICE_MOTION, ["roll", "pitch", "yaw"]),
+    ("earth_accel", "Earth Acceleration", "g's", EARTH_ACCEL_NAMES,
+        SensorData.MESSAGE_TYPE_DEVICE_MOTION, DERIVED_FIELDS),
+]
 
 
 def hide_border(ax):
@@ -64,7 +108,11 @@ def _fft_create(title, names, modes):
     fig, axes = plt.subplots(nrows=len(modes)+1, ncols=len(names),
         sharex=True, figsize=(15, 2*(len(modes)+1)))
     plt.suptitle(title)
-    fig.canvas.set_window_title(title)
+
+    # No window, e.g. with the Agg backend, doesn't have a manager
+    if fig.canvas.manager is not None:
+        fig.canvas.manager.set_window_title(title)
+
     fig.subplots_adjust(left=0.05, bottom=0.1, right=0.95, top=0.9,
         wspace=0.2, hspace=0.1)
 
@@ -78,9 +126,10 @@ def _fft_plot(data, units, names, modes, axes, fig, t):
 
     # For some reason sometimes t ends up being one more sample than data
     t = t[:len(data)]
+    data = np.asarray(data)
 
     for i in range(len(names)):
-        y = np.array([v[i] for v in data])
+        y = data[:, i]
         plot_list.append(axes[0][i].plot(t, y))
         axes[0][i].title.set_text(names[i])
         axes[0][i].margins(x=0)
@@ -123,15 +172,21 @@ def _fft_plot(data, units, names, modes, axes, fig, t):
     return plot_list, additional_axes
 
 
-def plot_fft(data, title, units, names=["x", "y", "z"]):
-    """ Plot single FFT, by default an FFT for each of x/y/z """
+def plot_fft(data, title, units, names=["x", "y", "z"], filename=None):
+    """ Plot single FFT, by default an FFT for each of x/y/z
+
+    If filename is given, save the figure to it and close it rather than
+    keeping it open to show. """
     t = np.arange(0.0, len(data)/FLAGS.freq, 1/FLAGS.freq)
 
     modes = get_modes()
     fig, axes = _fft_create(title, names, modes)
     _fft_plot(data, units, names, modes, axes, fig, t)
 
-    if FLAGS.save:
+    if filename is not None:
+        fig.savefig(filename, dpi=100, bbox_inches="tight", pad_inches=0)
+        plt.close(fig)
+    elif FLAGS.save:
         plt.savefig("Plots - "+title+".png", dpi=100,
             bbox_inches="tight", pad_inches=0)
 
@@ -210,6 +265,69 @@ def plot_data(messages, max_len=None):
         if max_len is not None and accel_i > max_len and motion_i > max_len:
             break
 
+    plot_groups(raw_accel, user_accel, grav, rot_rate, attitude)
+
+
+def plot_columns(input_filename):
+    """ Plot the accelerometer and device motion columns of a file (see
+    decode_columns), memory mapped from the cache if decoded before """
+    # Only import if needed
+    from columns import ACCEL_FIELDS, MOTION_FIELDS, decode_columns
+
+    accel = decode_columns(input_filename,
+        SensorData.MESSAGE_TYPE_ACCELEROMETER, ACCEL_FIELDS)
+    motion = decode_columns(input_filename,
+        SensorData.MESSAGE_TYPE_DEVICE_MOTION, MOTION_FIELDS)
+
+    def stack(columns, fields):
+        return np.stack([columns[field] for field in fields], axis=1)
+
+    plot_groups(stack(accel, ACCEL_FIELDS), stack(motion, MOTION_FIELDS[0:3]),
+        stack(motion, MOTION_FIELDS[3:6]), stack(motion, MOTION_FIELDS[6:9]),
+        stack(motion, MOTION_FIELDS[9:12]))
+
+
+def plot_pyramid(pyramid_dir):
+    """ Plot the decimated data from a pyramid (see pyramid.py) at its lower
+    sampling frequency """
+    # Only import if needed
+    from pyramid import load_decimated
+
+    accel, accel_freq = load_decimated(pyramid_dir, "accelerometer")
+    motion, motion_freq = load_decimated(pyramid_dir, "device_motion")
+    assert accel_freq == motion_freq, "expected same decimated frequencies"
+    FLAGS.freq = accel_freq
+
+    # (channels, samples) to (samples, channels), with the device motion
+    # channels in the order of MOTION_FIELDS in columns.py
+    accel = accel.T
+    motion = motion.T
+    plot_groups(accel, motion[:, 0:3], motion[:, 3:6], motion[:, 6:9],
+        motion[:, 9:12])
+
+
+def get_earth_accel(user_accel, attitude):
+    """ Get the derived channels of earth.py from the (samples, 3) user
+    acceleration and roll/pitch/yaw """
+    user_accel = np.asarray(user_accel, dtype=np.float32).reshape(-1, 3)
+    attitude = np.asarray(attitude, dtype=np.float32).reshape(-1, 3)
+    earth = to_earth_frame(user_accel, attitude[:, 0], attitude[:, 1],
+        attitude[:, 2])
+
+    return derive_channels(earth, user_accel)
+
+
+def get_groups():
+    """ Get the groups of channels to plot """
+    return [group for group in GROUPS
+        if group[0] != "earth_accel" or FLAGS.earth]
+
+
+def plot_groups(raw_accel, user_accel, grav, rot_rate, attitude):
+    """ Plot or animate the FFTs of each group of x/y/z data """
+    if FLAGS.earth or FLAGS.animate == "earth_accel":
+        earth_accel = get_earth_accel(user_accel, attitude)
+
     if FLAGS.animate != "none":
         # If we don't keep the returned value, it won't animate
         if FLAGS.animate == "raw_accel":
@@ -223,6 +341,9 @@ def plot_data(messages, max_len=None):
         elif FLAGS.animate == "attitude":
             ani = animate_fft(attitude, "Attitude", "rad",
                 names=["roll", "pitch", "yaw"])
+        elif FLAGS.animate == "earth_accel":
+            ani = animate_fft(earth_accel, "Earth Acceleration", "g's",
+                names=EARTH_ACCEL_NAMES)
 
         plt.show()
     else:
@@ -232,11 +353,162 @@ def plot_data(messages, max_len=None):
         plot_fft(rot_rate, "Rotation Rates", "rad/s")
         plot_fft(attitude, "Attitude", "rad", names=["roll", "pitch", "yaw"])
 
+        if FLAGS.earth:
+            plot_fft(earth_accel, "Earth Acceleration", "g's",
+                names=EARTH_ACCEL_NAMES)
+
         plt.show()
 
 
+def init_worker(argv):
+    """ Set up a worker process: no GUI, and the flags parsed if not already,
+    e.g. when not forked """
+    plt.switch_backend("Agg")
+
+    if not FLAGS.is_parsed():
+        FLAGS(argv)
+
+
+def decode_groups(input_filename, output_dir):
+    """ Decode a file, saving each group of channels as (samples, channels)
+    in a .npy file in the output directory """
+    # Only import if needed
+    from columns import ACCEL_FIELDS, MOTION_FIELDS, decode_columns
+
+    fields = {
+        SensorData.MESSAGE_TYPE_ACCELEROMETER: ACCEL_FIELDS,
+        SensorData.MESSAGE_TYPE_DEVICE_MOTION: MOTION_FIELDS,
+    }
+    columns = {message_type: decode_columns(input_filename, message_type,
+        message_fields) for message_type, message_fields in fields.items()}
+
+    if FLAGS.earth:
+        columns[SensorData.MESSAGE_TYPE_DEVICE_MOTION].update(earth_columns(
+            columns[SensorData.MESSAGE_TYPE_DEVICE_MOTION]))
+
+    os.makedirs(output_dir)
+
+    for group, _, _, _, message_type, group_fields in get_groups():
+        np.save(os.path.join(output_dir, group+".npy"), np.stack(
+            [columns[message_type][field] for field in group_fields], axis=1))
+
+
+def render_group(data_filename, title, units, names, output_filename):
+    """ Render the figure of one group of channels from its memory-mapped
+    .npy file """
+    plot_fft(np.load(data_filename, mmap_mode="r"), title, units, names,
+        filename=output_filename)
+
+
+def render_batch(input_filenames, output_dir, workers=None):
+    """ Render the figures of each file in a process pool, decoding each file
+    then rendering each of its groups in parallel
+
+    Only decodes a few files ahead of rendering them, and deletes the decoded
+    data of a file once its figures are done. Returns the number of figures
+    rendered and a list of (input file, error) for those that failed. """
+    workers = workers or os.cpu_count()
+    groups = get_groups()
+    to_decode = list(zip(input_filenames, get_output_names(input_filenames)))
+    renders_left = {}  # input file: number of its figures not done yet
+    running = {}  # future: (input file, output name, data directory, group)
+    rendered = 0
+    failures = []
+
+    # For the workers if not forked, since they then won't have the flags
+    argv = sys.argv[:1] + FLAGS.flags_into_string().splitlines()
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(prefix="fft-") as tmp_dir, \
+            ProcessPoolExecutor(workers, initializer=init_worker,
+                initargs=(argv,)) as executor:
+        while len(to_decode) > 0 or len(running) > 0:
+            # Only decode enough files ahead to keep all the workers busy
+            while len(to_decode) > 0 and len(renders_left) < 2*workers:
+                input_filename, name = to_decode.pop(0)
+                data_dir = os.path.join(tmp_dir, name)
+                future = executor.submit(decode_groups, input_filename,
+                    data_dir)
+                running[future] = (input_filename, name, data_dir, None)
+                renders_left[input_filename] = len(groups)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                input_filename, name, data_dir, group = running.pop(future)
+
+                if future.exception() is not None:
+                    failures.append((input_filename, repr(future.exception())))
+
+                    # If decoding failed, none of its figures will be done
+                    renders_left[input_filename] -= len(groups) \
+                        if group is None else 1
+                elif group is None:
+                    # Decoded, so now render each group
+                    for group, title, units, names, _, _ in groups:
+                        output_filename = os.path.join(output_dir,
+                            name+" - "+title+".png")
+                        render = executor.submit(render_group,
+                            os.path.join(data_dir, group+".npy"), title,
+                            units, names, output_filename)
+                        running[render] = (input_filename, name, data_dir,
+                            group)
+                else:
+                    rendered += 1
+                    renders_left[input_filename] -= 1
+
+                if renders_left[input_filename] == 0:
+                    del renders_left[input_filename]
+                    shutil.rmtree(data_dir, ignore_errors=True)
+
+    return rendered, failures
+
+
 def main(argv):
-    plot_data(decode(FLAGS.input, SensorData))
+    # Input files may be given with --input or after the flags
+    inputs = (FLAGS.input or []) + argv[1:]
+
+    if FLAGS.pyramid is None and len(inputs) == 0:
+        raise app.UsageError("--input or --pyramid is required")
+
+    if FLAGS.batch:
+        plt.switch_backend("Agg")
+
+        for input_fn in inputs:
+            if not os.path.exists(input_fn):
+                print("Error: input file does not exist:", input_fn)
+                exit(1)
+
+        rendered, failures = render_batch(list(dict.fromkeys(inputs)),
+            FLAGS.output_dir, FLAGS.workers)
+
+        for input_fn, error in failures:
+            print("Error: failed to plot", input_fn+":", error, file=sys.stderr)
+
+        print("Rendered", rendered, "figures", file=sys.stderr)
+
+        if len(failures) > 0:
+            exit(1)
+
+        return
+
+    if FLAGS.pyramid is not None:
+        plot_pyramid(FLAGS.pyramid)
+        return
+
+    if len(inputs) != 1:
+        raise app.UsageError("expected one input file without --batch")
+
+    if FLAGS.sort:
+        plot_columns(inputs[0])
+        return
+
+    # Skip parsing location and battery messages since we don't plot them
+    plot_data(decode(inputs[0], SensorData, {
+        SensorData.MESSAGE_TYPE_ACCELEROMETER,
+        SensorData.MESSAGE_TYPE_DEVICE_MOTION,
+    }))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+"""
+Index the size-prefixed messages in a file and get their epochs and message
+types with NumPy, without parsing each message
+
+Only finding where each message starts loops in Python, since each size
+depends on the previous one. Everything else is done on all the messages of
+a block at once.
+"""
+import numpy as np
+
+from decoding import open_file
+
+
+def index_frames(buf, eof=True):
+    """ Get the offsets and sizes of the messages in the buffer, and the
+    position after the last complete one
+
+    If not at the end of the file, a partial message at the end of the buffer
+    is left for the next block. """
+    offsets = []
+    sizes = []
+    end = len(buf)
+    pos = 0
+
+    while pos + 2 <= end:
+        start = pos + 2
+        size = buf[pos] | (buf[pos+1] << 8)  # little endian
+
+        if start + size > end and not eof:
+            break
+
+        offsets.append(start)
+        sizes.append(size)
+        pos = start + size
+
+    offsets = np.array(offsets, dtype=np.int64)
+
+    # A truncated message at the end of the file only has what's left
+    sizes = np.minimum(np.array(sizes, dtype=np.int64), end - offsets)
+
+    return offsets, sizes, min(pos, end)
+
+
+def peek_epochs_and_types(buf, offsets, sizes, message_type):
+    """ Get the epoch (field 1, a double) and message_type (field 3, a varint)
+    of each SensorData message, parsing only those not in the usual form:
+    epoch tag, 8 bytes, message_type tag, 1-byte message type """
+    data = np.frombuffer(buf, dtype=np.uint8)
+
+    # Indices past the end of the buffer are clipped, and those messages are
+    # then handled as irregular since they're shorter than 11 bytes
+    def at(i):
+        return data[np.minimum(offsets+i, len(data)-1)]
+
+    regular = (sizes >= 11) & (at(0) == 0x09) & (at(9) == 0x18) & (at(10) < 0x80)
+
+    byte_indices = np.minimum(offsets[:, None] + np.arange(1, 9), len(data)-1)
+    epochs = data[byte_indices].copy().view("<f8")[:, 0]
+    types = at(10).astype(np.int64)
+
+    for i in np.flatnonzero(~regular):
+        msg = message_type.FromString(buf[offsets[i]:offsets[i]+sizes[i]])
+        epochs[i] = msg.epoch
+        types[i] = msg.message_type
+
+    return epochs, types
+
+
+def scan_frames(filename, message_type, block_size=64 << 20):
+    """ Read a file in large blocks, yielding the block, offsets and sizes of
+    the messages in it, and their epochs and message types """
+    with open_file(filename, "rb") as f:
+        buf = b""
+        eof = False
+
+        while not eof:
+            block = f.read(block_size)
+            eof = block == b""
+            buf += block
+            offsets, sizes, end = index_frames(buf, eof)
+
+            if len(offsets) > 0:
+                epochs, types = peek_epochs_and_types(buf, offsets, sizes,
+                    message_type)
+                yield buf, offsets, sizes, epochs, types
+
+            buf = buf[end:]
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Ingestion server receiving sensor data and responses uploaded from the phone,
+and a client replaying existing files to it to measure throughput and latency
+
+    ./ingest.py serve storage/ --port 8765
+    ./ingest.py replay sensor_data.pb --port 8765 --rate 5000 --connections 4
+
+Protocol over TCP: the client sends a line "<device id> <kind>\\n", where kind
+is sensor_data, responses, or sensor_batch (see sensor_batch.py), then
+size-prefixed messages as in the files from the watch, then closes its side
+of the connection. As messages arrive, the server parses them to validate
+them and appends them to <storage>/<device id>/<kind>.pb, replying
+"ACK <messages stored>\\n" after each write. At the end it replies
+"OK <messages>\\n", or "ERR <reason>\\n" on an invalid message or if
+storing failed.
+
+Backpressure: the server doesn't read more from a connection until the last
+write is done, and only handles --max-connections uploads at a time.
+"""
+import os
+import re
+import sys
+import time
+import asyncio
+import argparse
+
+from google.protobuf.message import DecodeError
+
+from decoding import split_frames, read_frames
+from watch_data_pb2 import SensorData, PromptResponse, SensorBatch
+
+# Kind of upload: message type
+KINDS = {
+    "sensor_data": SensorData,
+    "responses": PromptResponse,
+    "sensor_batch": SensorBatch,
+}
+
+# Device IDs are used in paths, so only allow a safe set of characters
+DEVICE_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+# Max size of the header line
+MAX_HEADER = 1024
+
+
+class IngestServer:
+    """ Accept uploads, appending them to per-device files """
+    def __init__(self, storage_dir, max_connections=100, read_size=1 << 16):
+        self.storage_dir = storage_dir
+        self.read_size = read_size
+        self.connections = asyncio.Semaphore(max_connections)
+        self.locks = {}  # filename: lock, so uploads to one file don't mix
+        self.messages = 0
+
+    def get_lock(self, filename):
+        """ Get the lock for appending to a file """
+        if filename not in self.locks:
+            self.locks[filename] = asyncio.Lock()
+
+        return self.locks[filename]
+
+    async def handle(self, reader, writer):
+        """ Handle one upload """
+        async with self.connections:
+            try:
+                count = await self.receive(reader, writer)
+                writer.write(("OK "+str(count)+"\n").encode())
+            except (ValueError, DecodeError) as e:
+                writer.write(("ERR "+str(e)+"\n").encode())
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            except OSError as e:
+                # Couldn't store, e.g. the disk is full, so tell the client
+                # rather than leaving it waiting
+                print("Error storing upload:", e, file=sys.stderr)
+                writer.write(("ERR could not store: "
+                    + (e.strerror or str(e))+"\n").encode())
+
+            try:
+                await writer.drain()
+                writer.close()
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def receive(self, reader, writer):
+        """ Read the header, then validate and store messages as they arrive,
+        returning the number stored """
+        header = await reader.readline()
+
+        if len(header) > MAX_HEADER or not header.endswith(b"\n"):
+            raise ValueError("invalid header")
+
+        parts = header.decode(errors="replace").split()
+
+        if len(parts) != 2 or not DEVICE_ID.match(parts[0]) \
+                or parts[1] not in KINDS:
+            raise ValueError("invalid header")
+
+        device_id, kind = parts
+        message_type = KINDS[kind]
+        directory = os.path.join(self.storage_dir, device_id)
+        filename = os.path.join(directory, kind+".pb")
+        os.makedirs(directory, exist_ok=True)
+
+        loop = asyncio.get_running_loop()
+        buf = b""
+        count = 0
+
+        while True:
+            block = await reader.read(self.read_size)
+            frames, buf = split_frames(buf+block)
+
+            if block == b"" and len(buf) > 0:
+                raise ValueError("truncated message after "+str(count))
+
+            # Validate, only storing the messages before an invalid one
+            valid = []
+
+            for data in frames:
+                try:
+                    message_type.FromString(data)
+                except DecodeError:
+                    await self.store(loop, filename, valid)
+                    raise DecodeError("invalid message "+str(count+len(valid)))
+
+                valid.append(data)
+
+            if len(valid) > 0:
+                # Don't read more until written, so a slow disk slows the
+                # client rather than buffering in memory
+                await self.store(loop, filename, valid)
+                count += len(valid)
+                self.messages += len(valid)
+                writer.write(("ACK "+str(count)+"\n").encode())
+                await writer.drain()
+
+            if block == b"":
+                return count
+
+    async def store(self, loop, filename, frames):
+        """ Append messages to the file in a thread, so we don't block other
+        uploads """
+        if len(frames) == 0:
+            return
+
+        data = b"".join(len(frame).to_bytes(2, "little")+frame
+            for frame in frames)
+
+        async with self.get_lock(filename):
+            await loop.run_in_executor(None, append_file, filename, data)
+
+
+def append_file(filename, data):
+    """ Append the bytes to a file """
+    with open(filename, "ab") as f:
+        f.write(data)
+
+
+async def serve(storage_dir, host, port, max_connections):
+    """ Run the server until interrupted """
+    ingest_server = IngestServer(storage_dir, max_connections)
+    server = await asyncio.start_server(ingest_server.handle, host, port)
+    print("Listening on", ", ".join(str(s.getsockname())
+        for s in server.sockets), file=sys.stderr)
+
+    async with server:
+        await server.serve_forever()
+
+
+async def replay_file(filename, host, port, device_id, kind, rate, batch_size):
+    """ Upload a file, sending batch_size messages at a time at rate messages
+    per second (or as fast as possible if 0)
+
+    Returns the number of messages and latency of each, i.e. the time from
+    sending it to the server acknowledging it was stored. """
+    with open(filename, "rb") as f:
+        frames = list(read_frames(f))
+
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write((device_id+" "+kind+"\n").encode())
+    sent_times = []
+    latencies = []
+
+    async def read_acks():
+        """ Match acknowledgements with when we sent the messages """
+        while True:
+            line = (await reader.readline()).decode()
+
+            if line.startswith("ACK "):
+                acked = int(line.split()[1])
+                now = time.perf_counter()
+                latencies.extend(now - sent
+                    for sent in sent_times[len(latencies):acked])
+            elif line.startswith("OK "):
+                return int(line.split()[1])
+            else:
+                raise RuntimeError("upload failed: "+line.strip())
+
+    ack_task = asyncio.ensure_future(read_acks())
+    start = time.perf_counter()
+
+    for i in range(0, len(frames), batch_size):
+        # Wait until it's time for this batch at the given rate
+        if rate > 0:
+            delay = start + i/rate - time.perf_counter()
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        batch = frames[i:i+batch_size]
+        writer.write(b"".join(len(frame).to_bytes(2, "little")+frame
+            for frame in batch))
+        sent_times.extend([time.perf_counter()]*len(batch))
+        await writer.drain()
+
+    writer.write_eof()
+    count = await ack_task
+    writer.close()
+
+    return count, latencies
+
+
+async def replay(filenames, host, port, device_id, kind, rate, connections,
+        batch_size):
+    """ Upload each file over each of the connections at once, then print
+    the throughput and latency """
+    uploads = []
+
+    for filename in filenames:
+        if kind is None:
+            file_kind = "responses" if os.path.basename(filename) \
+                .startswith("responses") else "sensor_data"
+        else:
+            file_kind = kind
+
+        for i in range(connections):
+            uploads.append(replay_file(filename, host, port,
+                device_id+"-"+str(i) if connections > 1 else device_id,
+                file_kind, rate, batch_size))
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*uploads)
+    seconds = time.perf_counter() - start
+
+    messages = sum(count for count, _ in results)
+    latencies = sorted(latency for _, file_latencies in results
+        for latency in file_latencies)
+
+    print("Messages:", messages)
+    print("Seconds:", round(seconds, 3))
+    print("Messages/second:", round(messages / seconds, 1))
+
+    if len(latencies) > 0:
+        print("Latency mean (ms):",
+            round(1000*sum(latencies)/len(latencies), 2))
+
+        for name, fraction in [("p50", 0.5), ("p99", 0.99), ("max", 1.0)]:
+            i = min(int(fraction*len(latencies)), len(latencies)-1)
+            print("Latency "+name+" (ms):", round(1000*latencies[i], 2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the server")
+    serve_parser.add_argument("storage", help="directory to store uploads in")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8765)
+    serve_parser.add_argument("--max-connections", type=int, default=100,
+        help="max uploads to handle at once, others wait")
+
+    replay_parser = subparsers.add_parser("replay",
+        help="upload existing files to a server")
+    replay_parser.add_argument("files", nargs="+", help="input.pb files")
+    replay_parser.add_argument("--host", default="127.0.0.1")
+    replay_parser.add_argument("--port", type=int, default=8765)
+    replay_parser.add_argument("--device", default="replay",
+        help="device ID to upload as")
+    replay_parser.add_argument("--kind", default=None, choices=KINDS.keys(),
+        help="kind of data (default: responses if the filename starts with "
+        "responses, otherwise sensor_data)")
+    replay_parser.add_argument("--rate", type=float, default=0,
+        help="messages per second per connection, 0 for as fast as possible")
+    replay_parser.add_argument("--connections", type=int, default=1,
+        help="upload each file this many times at once, as different devices")
+    replay_parser.add_argument("--batch", type=int, default=100,
+        help="messages to send at a time")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        try:
+            asyncio.run(serve(args.storage, args.host, args.port,
+                args.max_connections))
+        except KeyboardInterrupt:
+            pass
+    else:
+        for filename in args.files:
+            if not os.path.exists(filename):
+                print("Error: input file does not exist:", filename)
+                exit(1)
+
+        asyncio.run(replay(args.files, args.host, args.port, args.device,
+            args.kind, args.rate, args.connections, args.batch))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+As-of join of the sensor data streams, e.g. annotate each accelerometer sample
+with the most recent location fix, the battery state, and the nearest label
+
+All joins are on sorted epoch arrays using searchsorted, so they take
+O(n log m) time without looping over rows in Python. Output is columnar (.npz
+file or directory of .npy files) with the joined fields prefixed by the stream
+name, e.g. location_latitude, each stream's matched epoch, e.g.
+location_epoch (NaN if no match), and whether there was a match, e.g.
+location_matched. Use the latter rather than the filled values to find
+samples without a match, since e.g. a location_floor of -1 is a real floor.
+"""
+import os
+import numpy as np
+
+from absl import app
+from absl import flags
+
+from columns import ACCEL_FIELDS, MOTION_FIELDS, LOCATION_FIELDS, \
+    BATTERY_FIELDS, decode_columns, get_labels, save_arrays
+from decoding import decode
+from earth import earth_columns
+from watch_data_pb2 import SensorData, PromptResponse
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("input", None, "Input sensor data protobuf file")
+flags.DEFINE_string("responses", None, "Input responses protobuf file, if any")
+flags.DEFINE_string("output", None, "Output .npz file, or directory for .npy files")
+flags.DEFINE_enum("stream", "accel", ["accel", "motion"], "Which samples to annotate")
+flags.DEFINE_float("location_tolerance", None, "Max seconds since the location fix, if any")
+flags.DEFINE_float("battery_tolerance", None, "Max seconds since the battery state, if any")
+flags.DEFINE_float("label_tolerance", None, "Max seconds to the nearest label, if any")
+flags.DEFINE_boolean("earth", False, "With --stream=motion, also output the user acceleration in the earth frame and the channels derived from it (see earth.py)")
+
+flags.mark_flag_as_required("input")
+flags.mark_flag_as_required("output")
+
+
+def asof_indices(left, right, direction="backward", tolerance=None):
+    """ For each epoch in left, get the index of the matching epoch in right,
+    or -1 if there is none (both must be sorted)
+
+    direction is one of:
+     - backward: last epoch in right <= the left epoch
+     - forward: first epoch in right >= the left epoch
+     - nearest: closest epoch in right, the earlier one on ties
+    tolerance is the max seconds between the two epochs, if any. """
+    left = np.asarray(left)
+    right = np.asarray(right)
+
+    if len(right) == 0:
+        return np.full(len(left), -1, dtype=np.int64)
+
+    if direction == "backward":
+        indices = np.searchsorted(right, left, side="right") - 1
+    elif direction == "forward":
+        indices = np.searchsorted(right, left, side="left")
+        indices[indices == len(right)] = -1
+    elif direction == "nearest":
+        after = np.searchsorted(right, left, side="left")
+        before = np.maximum(after-1, 0)
+        after = np.minimum(after, len(right)-1)
+        indices = np.where(
+            np.abs(left - right[before]) <= np.abs(right[after] - left),
+            before, after)
+    else:
+        raise NotImplementedError("unknown direction "+direction)
+
+    if tolerance is not None:
+        matched = indices != -1
+        distance = np.abs(left - right[np.where(matched, indices, 0)])
+        indices[matched & (distance > tolerance)] = -1
+
+    return indices
+
+
+def take(values, indices):
+    """ Get values at the indices, with a missing value for -1 indices: NaN for
+    floats, -1 for integers, and "" for strings
+
+    -1 may also be a real value, so check the indices for whether there was a
+    match. """
+    values = np.asarray(values)
+    missing = indices == -1
+
+    if values.dtype.kind == "f":
+        fill = np.nan
+    elif values.dtype.kind == "U":
+        fill = ""
+    else:
+        fill = -1
+
+    if len(values) == 0:
+        return np.full(len(indices), fill, dtype=values.dtype)
+
+    result = values[np.where(missing, 0, indices)]
+    result[missing] = fill
+
+    return result
+
+
+def asof_join(left, right, name, direction="backward", tolerance=None):
+    """ Join the columns of right onto left, which both include sorted "epoch"
+    arrays, naming the right columns <name>_<field>, with whether each row
+    matched in <name>_matched """
+    indices = asof_indices(left["epoch"], right["epoch"], direction, tolerance)
+    result = dict(left)
+    result[name+"_matched"] = indices != -1
+
+    for field, values in right.items():
+        result[name+"_"+field] = take(values, indices)
+
+    return result
+
+
+def annotate(samples, location, battery, response_messages=None):
+    """ Annotate each accelerometer or device motion sample with the most
+    recent location and battery state and the nearest activity label, all
+    as columns (see get_columns) """
+    result = dict(samples)
+
+    if FLAGS.stream == "motion" and FLAGS.earth:
+        result.update(earth_columns(result))
+
+    # Skip invalid fixes, see msg_to_json in decode_sensor_data.py
+    valid = (location["longitude"] != 0.0) | (location["latitude"] != 0.0) \
+        | (location["horiz_acc"] != 0.0)
+    location = {field: values[valid] for field, values in location.items()}
+
+    result = asof_join(result, location, "location", "backward",
+        FLAGS.location_tolerance)
+    result = asof_join(result, battery, "battery", "backward",
+        FLAGS.battery_tolerance)
+
+    if response_messages is not None:
+        label_epochs, labels = get_labels(response_messages)
+        result = asof_join(result, {"epoch": label_epochs, "label": labels},
+            "response", "nearest", FLAGS.label_tolerance)
+
+    return result
+
+
+def main(argv):
+    if os.path.exists(FLAGS.output):
+        print("Error: output exists:", FLAGS.output)
+        exit(1)
+
+    responses = None
+
+    if FLAGS.responses is not None:
+        responses = decode(FLAGS.responses, PromptResponse)
+
+    if FLAGS.stream == "accel":
+        samples = decode_columns(FLAGS.input,
+            SensorData.MESSAGE_TYPE_ACCELEROMETER, ACCEL_FIELDS)
+    else:
+        samples = decode_columns(FLAGS.input,
+            SensorData.MESSAGE_TYPE_DEVICE_MOTION, MOTION_FIELDS)
+
+    location = decode_columns(FLAGS.input, SensorData.MESSAGE_TYPE_LOCATION,
+        LOCATION_FIELDS)
+    battery = decode_columns(FLAGS.input, SensorData.MESSAGE_TYPE_BATTERY,
+        BATTERY_FIELDS)
+    save_arrays(annotate(samples, location, battery, responses), FLAGS.output)
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -5,20 +5,24 @@ Convert the sensor data lat/lon/alt to a KML file to visualize in Google Earth
 pip install --user fastkml
 sudo pacman -S python-shapely
 """
-import os
-import sys
+import argparse
 
 from datetime import datetime
 from fastkml import kml, styles, geometry
 
-from decoding import decode
+from columns import LOCATION_FIELDS, decode_columns
+from decoding import add_file_arguments, get_file_pairs, open_file
+from location import valid_fixes
 from watch_data_pb2 import SensorData
 
 
-def write_kml(messages, output_filename):
-    """ Sort messages on timestamp, convert to KML and write to disk """
-    # Sort since when saving to a file on the watch, they may be out of order
-    messages.sort(key=lambda x: x.epoch)
+def write_kml(location, output_filename):
+    """ Convert the location columns (see get_columns), sorted on timestamp,
+    to KML and write to disk """
+    # Skip if invalid lat/lon/alt value
+    valid = valid_fixes(location)
+    fixes = zip(*(location[field][valid].tolist()
+        for field in ["epoch", "longitude", "latitude", "altitude"]))
 
     # Create KML file
     k = kml.KML()
@@ -32,52 +36,40 @@ def write_kml(messages, output_filename):
         styles.PolyStyle(ns, 'polystyle', '00FFFFFF'),
     ])]
 
-    i = 0
     pt_prev = None
     ts_prev = None
 
-    for msg in messages:
-        if msg.message_type == SensorData.MESSAGE_TYPE_LOCATION:
-            # Skip if invalid lat/lon/alt value
-            if msg.longitude == 0.0 and msg.latitude == 0.0 and msg.horiz_acc == 0.0:
-                continue
-            if msg.altitude == 0.0 and msg.vert_acc == 0.0:
-                continue
-
-            ts = datetime.fromtimestamp(msg.epoch)
-            pt = (msg.longitude, msg.latitude, msg.altitude)
-
-            # We're drawing lines between points, so skip the first point
-            if i != 0:
-                p = kml.Placemark(ns, 'point-'+str(i), 'point-'+str(i), styles=s)
-                p.geometry = geometry.Geometry(ns, 'geometry-'+str(i),
-                    geometry.Polygon([pt_prev, pt, pt, pt_prev]),
-                    altitude_mode='absolute')
-                p.begin = ts_prev
-                p.end = ts
-                f.append(p)
-
-            i += 1
-            pt_prev = pt
-            ts_prev = ts
-
-    with open(output_filename, "w") as f:
+    for i, (epoch, longitude, latitude, altitude) in enumerate(fixes):
+        ts = datetime.fromtimestamp(epoch)
+        pt = (longitude, latitude, altitude)
+
+        # We're drawing lines between points, so skip the first point
+        if i != 0:
+            p = kml.Placemark(ns, 'point-'+str(i), 'point-'+str(i), styles=s)
+            p.geometry = geometry.Geometry(ns, 'geometry-'+str(i),
+                geometry.Polygon([pt_prev, pt, pt, pt_prev]),
+                altitude_mode='absolute')
+            p.begin = ts_prev
+            p.end = ts
+            f.append(p)
+
+        pt_prev = pt
+        ts_prev = ts
+
+    with open_file(output_filename, "w") as f:
         f.write(k.to_string(prettyprint=True))
 
 
-if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: ./kml.py input.pb output.kml")
-        exit(1)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    add_file_arguments(parser, ".kml")
+    args = parser.parse_args(argv)
 
-    input_fn = sys.argv[1]
-    output_fn = sys.argv[2]
+    for input_fn, output_fn in get_file_pairs(args, ".kml"):
+        location = decode_columns(input_fn, SensorData.MESSAGE_TYPE_LOCATION,
+            LOCATION_FIELDS)
+        write_kml(location, output_fn)
 
-    if not os.path.exists(input_fn):
-        print("Error: input file does not exist:", input_fn)
-        exit(1)
-    if os.path.exists(output_fn):
-        print("Error: output file exists:", output_fn)
-        exit(1)
 
-    write_kml(decode(input_fn, SensorData), output_fn)
+if __name__ == "__main__":
+    main()
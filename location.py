@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Find stay points and trips in the location data, with the distance and speed
+of each trip
+
+A stay point is where the fixes stay within --stay-distance meters of the
+first one for at least --stay-time seconds (Li et al., "Mining user similarity
+based on location history", 2008). Trips are the fixes between stay points,
+split where there are no fixes for --max-gap seconds.
+
+Writes summary.json with the stay points and trips, and a CSV file of the
+fixes of each trip, e.g. output/trips/trip_0001.csv.
+
+Everything is computed on arrays of all the fixes at once, except for
+checking where each stay point ends, which only loops over stay points.
+"""
+import os
+import json
+import argparse
+import numpy as np
+
+from columns import LOCATION_FIELDS, decode_columns
+from watch_data_pb2 import SensorData
+
+# Mean radius of the Earth in meters
+EARTH_RADIUS = 6371008.8
+
+# Columns of the CSV file of each trip
+TRIP_COLUMNS = ["epoch", "latitude", "longitude", "altitude", "horiz_acc",
+    "distance", "speed"]
+TRIP_FORMATS = ["%.6f", "%.7f", "%.7f", "%.2f", "%.2f", "%.2f", "%.3f"]
+
+
+def valid_fixes(location, max_horiz_acc=None):
+    """ Get which fixes are valid, skipping the same ones as write_kml in
+    kml.py, and optionally those less accurate than max_horiz_acc meters """
+    invalid_horizontal = (location["longitude"] == 0.0) \
+        & (location["latitude"] == 0.0) & (location["horiz_acc"] == 0.0)
+    invalid_vertical = (location["altitude"] == 0.0) \
+        & (location["vert_acc"] == 0.0)
+    valid = ~invalid_horizontal & ~invalid_vertical
+
+    if max_horiz_acc is not None:
+        valid &= location["horiz_acc"] <= max_horiz_acc
+
+    return valid
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Great-circle distance in meters between points in degrees """
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=np.float64))
+        for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1)/2)**2 \
+        + np.cos(lat1)*np.cos(lat2)*np.sin((lon2 - lon1)/2)**2
+
+    return 2*EARTH_RADIUS*np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def step_distances(lat, lon):
+    """ Distance in meters from each fix to the next """
+    return haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+
+
+def step_speeds(epochs, distances):
+    """ Speed in m/s from each fix to the next, 0 if at the same time """
+    dt = np.diff(epochs)
+    return np.divide(distances, dt, out=np.zeros_like(distances),
+        where=dt > 0)
+
+
+def first_outside(lat, lon, anchor, max_distance, chunk=64):
+    """ Get the index of the first fix after the anchor that is more than
+    max_distance meters from it, or the number of fixes if none are
+
+    Checks chunks of fixes at a time, doubling in size, so a long stay takes
+    few steps. """
+    start = anchor + 1
+
+    while start < len(lat):
+        stop = min(len(lat), start + chunk)
+        outside = haversine(lat[anchor], lon[anchor], lat[start:stop],
+            lon[start:stop]) > max_distance
+
+        if outside.any():
+            return start + int(np.argmax(outside))
+
+        start = stop
+        chunk *= 2
+
+    return len(lat)
+
+
+def find_stay_points(epochs, lat, lon, max_distance=200.0, min_duration=1200.0):
+    """ Find where the fixes stay within max_distance meters of the first one
+    for at least min_duration seconds
+
+    Returns a list of (start, end) indices of the fixes of each stay point,
+    end exclusive. """
+    # A stay can only start at a fix if the first fix at least min_duration
+    # later is still close, so only check those, skipping over the others
+    later = np.searchsorted(epochs, epochs + min_duration)
+    has_later = later < len(epochs)
+    candidates = np.flatnonzero(has_later)
+    candidates = candidates[haversine(lat[candidates], lon[candidates],
+        lat[later[candidates]], lon[later[candidates]]) <= max_distance]
+
+    stays = []
+    pos = 0
+
+    while True:
+        i = np.searchsorted(candidates, pos)
+
+        if i == len(candidates):
+            break
+
+        anchor = int(candidates[i])
+        end = first_outside(lat, lon, anchor, max_distance)
+
+        if epochs[end-1] - epochs[anchor] >= min_duration:
+            stays.append((anchor, end))
+            pos = end
+        else:
+            pos = anchor + 1
+
+    return stays
+
+
+def get_stay_ids(length, stays):
+    """ Get which stay point each fix is in, numbered from 1, or 0 if none """
+    stay_ids = np.zeros(length, dtype=np.int64)
+
+    for i, (start, end) in enumerate(stays):
+        stay_ids[start:end] = i+1
+
+    return stay_ids
+
+
+def find_trips(epochs, stays, max_gap=1800.0):
+    """ Find the trips: the fixes not in a stay point, plus the last fix of
+    the stay point before and the first fix of the one after, split where
+    there are no fixes for more than max_gap seconds
+
+    Returns a list of (start, end) indices of the fixes of each trip, end
+    exclusive. """
+    stay_ids = get_stay_ids(len(epochs), stays)
+
+    # Whether moving from each fix to the next is part of a trip
+    same_stay = (stay_ids[:-1] == stay_ids[1:]) & (stay_ids[1:] > 0)
+    moving = ~same_stay & (np.diff(epochs) <= max_gap)
+
+    # Each run of moving steps is a trip
+    padded = np.concatenate([[False], moving, [False]])
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+
+    return list(zip(changes[0::2].tolist(), (changes[1::2]+1).tolist()))
+
+
+def summarize(location, stays, trips, distances, speeds):
+    """ Get the summary of each stay point and trip """
+    epochs = location["epoch"]
+    lat = location["latitude"]
+    lon = location["longitude"]
+    stay_ids = get_stay_ids(len(epochs), stays)
+    stay_summaries = []
+    trip_summaries = []
+
+    for i, (start, end) in enumerate(stays):
+        stay_summaries.append({
+            "stay": i+1,
+            "latitude": float(np.mean(lat[start:end])),
+            "longitude": float(np.mean(lon[start:end])),
+            "start_epoch": float(epochs[start]),
+            "end_epoch": float(epochs[end-1]),
+            "duration": float(epochs[end-1] - epochs[start]),
+            "fixes": end - start,
+        })
+
+    # Total distance and max speed of each trip from the steps in it
+    cumulative = np.concatenate([[0.0], np.cumsum(distances)])
+    starts = np.array([start for start, _ in trips], dtype=np.int64)
+    ends = np.array([end for _, end in trips], dtype=np.int64)
+    trip_distances = cumulative[ends-1] - cumulative[starts]
+
+    # reduceat goes up to the next start, so zero the steps not in a trip
+    in_trip = np.zeros(len(speeds)+1, dtype=np.int64)
+    np.add.at(in_trip, starts, 1)
+    np.add.at(in_trip, ends-1, -1)
+    trip_speeds = np.where(np.cumsum(in_trip[:-1]) > 0, speeds, 0.0)
+    max_speeds = np.maximum.reduceat(trip_speeds, starts) if len(trips) > 0 \
+        else np.zeros(0)
+
+    for i, (start, end) in enumerate(trips):
+        duration = float(epochs[end-1] - epochs[start])
+        trip_summaries.append({
+            "trip": i+1,
+            "start_epoch": float(epochs[start]),
+            "end_epoch": float(epochs[end-1]),
+            "duration": duration,
+            "fixes": end - start,
+            "distance": float(trip_distances[i]),
+            "mean_speed": float(trip_distances[i]) / duration
+                if duration > 0 else None,
+            "max_speed": float(max_speeds[i]),
+            "from_stay": int(stay_ids[start]) or None,
+            "to_stay": int(stay_ids[end-1]) or None,
+            "start_latitude": float(lat[start]),
+            "start_longitude": float(lon[start]),
+            "end_latitude": float(lat[end-1]),
+            "end_longitude": float(lon[end-1]),
+        })
+
+    return stay_summaries, trip_summaries
+
+
+def analyze(location, stay_distance=200.0, stay_time=1200.0, max_gap=1800.0,
+        max_horiz_acc=None):
+    """ Find the stay points and trips in the location columns (see
+    get_columns), returning the valid fixes, the distance and speed from
+    each to the next, the (start, end) indices of the fixes of each trip,
+    and the summary """
+    valid = valid_fixes(location, max_horiz_acc)
+    fixes = {field: values[valid] for field, values in location.items()}
+    epochs = fixes["epoch"]
+
+    distances = step_distances(fixes["latitude"], fixes["longitude"])
+    speeds = step_speeds(epochs, distances)
+    stays = find_stay_points(epochs, fixes["latitude"], fixes["longitude"],
+        stay_distance, stay_time)
+    trips = find_trips(epochs, stays, max_gap)
+    stay_summaries, trip_summaries = summarize(fixes, stays, trips, distances,
+        speeds)
+
+    summary = {
+        "fixes": len(location["epoch"]),
+        "valid_fixes": len(epochs),
+        "distance": sum(trip["distance"] for trip in trip_summaries),
+        "stay_points": stay_summaries,
+        "trips": trip_summaries,
+    }
+
+    return fixes, distances, speeds, trips, summary
+
+
+def write_trips(fixes, distances, speeds, trips, summary, output_dir):
+    """ Write the summary and a CSV file of the fixes of each trip, with the
+    distance and speed from the previous fix """
+    trips_dir = os.path.join(output_dir, "trips")
+    os.makedirs(trips_dir)
+
+    # Distance and speed from the previous fix rather than to the next
+    from_previous = {
+        "distance": np.concatenate([[0.0], distances]),
+        "speed": np.concatenate([[0.0], speeds]),
+    }
+
+    for i, (start, end) in enumerate(trips):
+        table = np.column_stack([from_previous[name][start:end]
+            if name in from_previous else fixes[name][start:end]
+            for name in TRIP_COLUMNS])
+
+        # The first fix is at 0 since the previous one isn't in the trip
+        table[0, TRIP_COLUMNS.index("distance")] = 0.0
+        table[0, TRIP_COLUMNS.index("speed")] = 0.0
+
+        np.savetxt(os.path.join(trips_dir, "trip_{:04d}.csv".format(i+1)),
+            table, fmt=TRIP_FORMATS, delimiter=",",
+            header=",".join(TRIP_COLUMNS), comments="")
+
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+        f.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("input", help="input.pb")
+    parser.add_argument("output", help="output directory")
+    parser.add_argument("--stay-distance", type=float, default=200.0,
+        help="max meters from the first fix of a stay point")
+    parser.add_argument("--stay-time", type=float, default=1200.0,
+        help="min seconds of a stay point")
+    parser.add_argument("--max-gap", type=float, default=1800.0,
+        help="split trips where there are no fixes for this many seconds")
+    parser.add_argument("--max-horiz-acc", type=float, default=None,
+        help="skip fixes less accurate than this many meters")
+    args = parser.parse_args(argv)
+
+    if args.input != "-" and not os.path.exists(args.input):
+        print("Error: input file does not exist:", args.input)
+        exit(1)
+    if os.path.exists(args.output):
+        print("Error: output directory exists:", args.output)
+        exit(1)
+
+    location = decode_columns(args.input, SensorData.MESSAGE_TYPE_LOCATION,
+        LOCATION_FIELDS)
+    fixes, distances, speeds, trips, summary = analyze(location,
+        args.stay_distance, args.stay_time, args.max_gap, args.max_horiz_acc)
+    write_trips(fixes, distances, speeds, trips, summary, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Decode sensor data into one file per day and message type, e.g.
+output/2019-06-07/accelerometer.ndjson, so later processing can read only the
+days and message types it needs. Files are written in parallel.
+
+A manifest.json in the output directory lists each file's message type,
+number of messages, and first and last epoch. Message types not in
+watch-data.proto are named by number, e.g. unknown_9.ndjson, and with
+--format npz, message types we don't have a list of fields for get all the
+fields that aren't always 0.
+"""
+import os
+import json
+import argparse
+
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from decoding import decode, drop_duplicates, print_dropped
+from decode_sensor_data import msg_to_json
+from watch_data_pb2 import SensorData
+
+# Prefix of the MessageType enum names, removed for the filenames
+TYPE_PREFIX = "MESSAGE_TYPE_"
+
+
+def get_type_name(message_type):
+    """ Get the MessageType enum name, or unknown_<number> if it isn't a
+    known one, as in quality.py """
+    try:
+        return SensorData.MessageType.Name(message_type)
+    except ValueError:
+        return "unknown_"+str(message_type)
+
+
+def get_shard_key(msg):
+    """ Get the date and message type name of a message, e.g.
+    ("2019-06-07", "MESSAGE_TYPE_ACCELEROMETER") """
+    return (str(datetime.fromtimestamp(msg.epoch).date()),
+        get_type_name(msg.message_type))
+
+
+def get_shard_path(date, message_type, output_format):
+    """ Get the path of a shard relative to the output directory """
+    if message_type.startswith(TYPE_PREFIX):
+        message_type = message_type[len(TYPE_PREFIX):]
+
+    return os.path.join(date, message_type.lower()+"."+output_format)
+
+
+def write_ndjson(messages, filename):
+    """ Write one JSON object per line """
+    with open(filename, "w") as f:
+        for msg in messages:
+            f.write(msg_to_json(msg))
+            f.write("\n")
+
+
+def get_npz_fields(messages):
+    """ Get the fields to save of messages of one message type: ours for the
+    message types we know, otherwise all the fields that aren't always 0 """
+    # Only import NumPy if needed
+    from columns import ACCEL_FIELDS, MOTION_FIELDS, LOCATION_FIELDS, \
+        BATTERY_FIELDS
+
+    fields = {
+        SensorData.MESSAGE_TYPE_ACCELEROMETER: ACCEL_FIELDS,
+        SensorData.MESSAGE_TYPE_DEVICE_MOTION: MOTION_FIELDS,
+        SensorData.MESSAGE_TYPE_LOCATION: LOCATION_FIELDS,
+        SensorData.MESSAGE_TYPE_BATTERY: BATTERY_FIELDS,
+    }
+
+    message_type = messages[0].message_type
+
+    if message_type in fields:
+        return fields[message_type]
+
+    return [field.name for field in SensorData.DESCRIPTOR.fields
+        if field.name not in ["epoch", "message_type"]
+        and any(getattr(msg, field.name) != field.default_value
+            for msg in messages)]
+
+
+def write_npz(messages, filename, fields):
+    """ Write the given fields of one message type as arrays in a .npz
+    file """
+    from columns import get_columns, save_arrays
+
+    save_arrays(get_columns(messages, messages[0].message_type, fields),
+        filename)
+
+
+def write_shard(messages, filename, output_format, fields=None):
+    """ Write the messages of one shard, with the fields to save if npz """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    if output_format == "ndjson":
+        write_ndjson(messages, filename)
+    elif output_format == "npz":
+        write_npz(messages, filename, fields)
+    else:
+        raise NotImplementedError("unknown format "+output_format)
+
+
+def write_partitioned(messages, output_dir, output_format="ndjson",
+        workers=None, dedup=False):
+    """ Sort messages on timestamp, split by day and message type, and write
+    each shard in parallel along with a manifest
+
+    If dedup, drop duplicate messages, returning the number dropped. """
+    # Sort since when saving to a file on the watch, they may be out of order
+    messages.sort(key=lambda x: x.epoch)
+    dropped = drop_duplicates(messages) if dedup else 0
+
+    shards = {}
+
+    for msg in messages:
+        shards.setdefault(get_shard_key(msg), []).append(msg)
+
+    if output_format not in ["ndjson", "npz"]:
+        raise NotImplementedError("unknown format "+output_format)
+
+    manifest = []
+    paths = []
+    fields = []
+
+    # Work out everything before creating the directory, so we don't leave
+    # a partial output directory if something is wrong
+    for (date, message_type), shard in sorted(shards.items()):
+        path = get_shard_path(date, message_type, output_format)
+        paths.append(os.path.join(output_dir, path))
+        fields.append(get_npz_fields(shard) if output_format == "npz"
+            else None)
+        manifest.append({
+            "path": path,
+            "date": date,
+            "message_type": message_type,
+            "rows": len(shard),
+            "first_epoch": shard[0].epoch,
+            "last_epoch": shard[-1].epoch,
+        })
+
+    os.makedirs(output_dir)
+
+    with ProcessPoolExecutor(workers) as executor:
+        # Get the results so any exceptions are raised
+        list(executor.map(write_shard, [shards[key] for key in sorted(shards)],
+            paths, [output_format]*len(paths), fields))
+
+    with open(os.path.join(output_dir, "manifest.json"), "w") as f:
+        json.dump({"shards": manifest}, f, indent=2)
+        f.write("\n")
+
+    return dropped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("input", help="input.pb")
+    parser.add_argument("output", help="output directory")
+    parser.add_argument("-f", "--format", default="ndjson",
+        choices=["ndjson", "npz"], help="format of each file")
+    parser.add_argument("-j", "--workers", type=int, default=None,
+        help="write files in this many processes")
+    parser.add_argument("--dedup", action="store_true",
+        help="drop duplicate messages, e.g. if the same file was downloaded "
+        "twice, and report how many")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.input):
+        print("Error: input file does not exist:", args.input)
+        exit(1)
+    if os.path.exists(args.output):
+        print("Error: output directory exists:", args.output)
+        exit(1)
+
+    dropped = write_partitioned(decode(args.input, SensorData), args.output,
+        args.format, args.workers, args.dedup)
+
+    if args.dedup:
+        print_dropped(dropped)
+
+
+if __name__ == "__main__":
+    main()
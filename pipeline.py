@@ -0,0 +1,170 @@
+"""
+Pipelined decoding, so that reading, parsing, serializing and writing run at
+the same time rather than one after another
+
+The stages are connected by bounded queues:
+ - read: a thread reads the file ahead in large blocks and splits it into
+   batches of messages
+ - parse: the main thread gets the epoch of each message for sorting
+ - serialize: worker processes parse and convert sorted batches to JSON,
+   keeping the results in order
+ - write: a thread writes the JSON to disk
+
+Sorting needs all the epochs, so serializing starts once the file is read.
+"""
+import os
+import queue
+import threading
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from decoding import open_file, read_frame_blocks, peek_epoch, Deduplicator
+
+# Put on a queue after the last item
+DONE = None
+
+
+class Stage(threading.Thread):
+    """ Run a function in a thread, keeping any exception to raise on join """
+    def __init__(self, fn, *args):
+        super().__init__(daemon=True)
+        self.fn = fn
+        self.args = args
+        self.error = None
+
+    def run(self):
+        try:
+            self.fn(*self.args)
+        except BaseException as e:
+            self.error = e
+
+    def join(self, timeout=None):
+        super().join(timeout)
+
+        if self.error is not None:
+            raise self.error
+
+
+def read_stage(filename, batch_size, output_queue):
+    """ Read batches of messages' bytes from the file onto the queue """
+    try:
+        with open_file(filename, "rb") as f:
+            for frames in read_frame_blocks(f):
+                for i in range(0, len(frames), batch_size):
+                    output_queue.put(frames[i:i+batch_size])
+    finally:
+        output_queue.put(DONE)
+
+
+def write_stage(f, input_queue):
+    """ Write strings from the queue to the file """
+    error = None
+
+    while True:
+        text = input_queue.get()
+
+        if text is DONE:
+            break
+
+        # Keep emptying the queue on error, otherwise the producer may block
+        if error is None:
+            try:
+                f.write(text)
+            except BaseException as e:
+                error = e
+
+    if error is not None:
+        raise error
+
+
+def iterate_queue(input_queue):
+    """ Yield items from the queue until DONE """
+    while True:
+        item = input_queue.get()
+
+        if item is DONE:
+            break
+
+        yield item
+
+
+def ordered_map(executor, fn, iterable, max_pending, *args):
+    """ Like executor.map() but only submitting up to max_pending items ahead
+    of the results we have yielded, so memory use is bounded """
+    pending = deque()
+
+    for item in iterable:
+        pending.append(executor.submit(fn, item, *args))
+
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
+def serialize_batch(batch, message_type, msg_to_json_fn):
+    """ Parse a batch of messages' bytes and convert to JSON """
+    return ",\n".join(msg_to_json_fn(message_type.FromString(data))
+        for data in batch)
+
+
+def write_messages_pipelined(input_filename, message_type, msg_to_json_fn,
+        output_filename, workers=None, batch_size=4096, queue_size=16,
+        dedup=False):
+    """ Decode, sort on timestamp, convert to JSON and write to disk, with
+    the same output as write_messages(), returning the number of duplicates
+    dropped if dedup """
+    if workers is None:
+        workers = os.cpu_count()
+
+    read_queue = queue.Queue(queue_size)
+    reader = Stage(read_stage, input_filename, batch_size, read_queue)
+    reader.start()
+
+    frames = []
+    epochs = []
+
+    for batch in iterate_queue(read_queue):
+        frames += batch
+        epochs += [peek_epoch(data, message_type) for data in batch]
+
+    reader.join()
+
+    # Sort since when saving to a file on the watch, they may be out of order
+    order = sorted(range(len(frames)), key=epochs.__getitem__)
+    deduplicator = Deduplicator()
+
+    if dedup:
+        order = [i for i in order
+            if not deduplicator.is_duplicate(epochs[i], frames[i])]
+
+    batches = ([frames[j] for j in order[i:i+batch_size]]
+        for i in range(0, len(order), batch_size))
+
+    try:
+        with open_file(output_filename, "w") as f, \
+                ProcessPoolExecutor(workers) as executor:
+            write_queue = queue.Queue(queue_size)
+            writer = Stage(write_stage, f, write_queue)
+            writer.start()
+
+            try:
+                write_queue.put("[")
+
+                for i, text in enumerate(ordered_map(executor,
+                        serialize_batch, batches, 2*workers, message_type,
+                        msg_to_json_fn)):
+                    # Invalid JSON if we have an extra comma at the end
+                    write_queue.put(text if i == 0 else ",\n"+text)
+
+                write_queue.put("]\n")
+            finally:
+                write_queue.put(DONE)
+                writer.join()
+    except BrokenPipeError:
+        # Whatever is reading our output exited, e.g. head, so stop quietly
+        pass
+
+    return deduplicator.dropped
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Build a multi-resolution pyramid of the accelerometer and device motion data
+for quickly plotting overviews of long recordings
+
+For each stream, each level summarizes buckets of 2, 4, 8, ... samples with
+the min, max, mean, and RMS of each channel. Each level is computed from the
+one below, all channels at once. The levels are stored in one .npy file per
+stream, (stats, channels, buckets), that can be memory mapped, with the
+offset of each level in index.json. Optionally, a low-pass filtered and
+decimated signal is saved too, e.g. for spectrograms (fft.py --pyramid).
+
+    ./pyramid.py build sensor_data.pb pyramid/ --decimate 5
+    ./pyramid.py plot pyramid/ --stream accelerometer --width 2000
+"""
+import os
+import json
+import argparse
+import numpy as np
+
+from columns import ACCEL_FIELDS, MOTION_FIELDS, decode_columns
+from watch_data_pb2 import SensorData
+
+# Stream name: (message type, fields)
+STREAMS = {
+    "accelerometer": (SensorData.MESSAGE_TYPE_ACCELEROMETER, ACCEL_FIELDS),
+    "device_motion": (SensorData.MESSAGE_TYPE_DEVICE_MOTION, MOTION_FIELDS),
+}
+
+# Order of the statistics in the first dimension of the pyramid
+STATS = ["min", "max", "mean", "rms"]
+
+
+def pairwise(values, fill, fn):
+    """ Combine each pair of values along the last axis, padding with fill if
+    there's an odd number """
+    if values.shape[-1] % 2 == 1:
+        pad = np.full(values.shape[:-1]+(1,), fill, dtype=values.dtype)
+        values = np.concatenate([values, pad], axis=-1)
+
+    return fn(values[..., 0::2], values[..., 1::2])
+
+
+def build_levels(data):
+    """ Compute the levels of the pyramid from (channels, samples) data
+
+    Returns a list of (stats, channels, buckets) arrays for bucket sizes 2, 4,
+    8, ... until one bucket covers all the samples, at least one level if
+    there are any samples. Partial buckets at the end are summarized over
+    only the samples they have. """
+    data = data.astype(np.float64)
+    low = data
+    high = data
+    total = data
+    squares = np.square(data)
+    counts = np.ones(data.shape[-1])
+    levels = []
+
+    while low.shape[-1] > 1 or (low.shape[-1] == 1 and len(levels) == 0):
+        low = pairwise(low, np.inf, np.minimum)
+        high = pairwise(high, -np.inf, np.maximum)
+        total = pairwise(total, 0.0, np.add)
+        squares = pairwise(squares, 0.0, np.add)
+        counts = pairwise(counts, 0.0, np.add)
+        levels.append(np.stack([
+            low, high, total / counts, np.sqrt(squares / counts),
+        ]).astype(np.float32))
+
+    return levels
+
+
+def lowpass_decimate(data, factor, taps_per_factor=16):
+    """ Low-pass filter (channels, samples) data with a windowed-sinc FIR
+    filter below the new Nyquist frequency, then keep every factor-th sample """
+    if factor <= 1:
+        return data.astype(np.float32)
+    elif data.shape[-1] == 0:
+        return np.zeros((len(data), 0), dtype=np.float32)
+
+    # Cutoff at 0.8 of the new Nyquist frequency, as a fraction of the old
+    # sampling frequency, to leave room for the transition band
+    cutoff = 0.8 * 0.5 / factor
+    n = np.arange(taps_per_factor*factor+1) - taps_per_factor*factor/2
+    taps = 2*cutoff * np.sinc(2*cutoff*n) * np.hamming(len(n))
+    taps /= taps.sum()
+
+    # Keep the centred samples of the full convolution, since mode="same"
+    # gives len(taps) samples if there are fewer
+    start = (len(taps) - 1) // 2
+    end = start + data.shape[-1]
+
+    return np.stack([
+        np.convolve(channel, taps)[start:end:factor] for channel in data
+    ]).astype(np.float32)
+
+
+def build_pyramid(streams, output_dir, freq, decimate=1):
+    """ Build and save the pyramid and decimated signal of each stream, given
+    the columns of each (see get_columns) """
+    os.makedirs(output_dir)
+    index = {"freq": freq, "stats": STATS, "streams": {}}
+
+    for name, (_, fields) in STREAMS.items():
+        columns = streams[name]
+        data = np.stack([columns[field] for field in fields])
+        epochs = columns["epoch"]
+        levels = build_levels(data)
+
+        info = {
+            "channels": fields,
+            "samples": len(epochs),
+            "levels": [],
+        }
+        offset = 0
+
+        for i, level in enumerate(levels):
+            info["levels"].append({
+                "bucket_size": 2**(i+1),
+                "offset": offset,
+                "buckets": level.shape[-1],
+            })
+            offset += level.shape[-1]
+
+        # Concatenate the levels into one file, with the epoch each bucket
+        # starts at in another
+        pyramid = np.lib.format.open_memmap(
+            os.path.join(output_dir, name+".npy"), mode="w+",
+            dtype=np.float32, shape=(len(STATS), len(fields), offset))
+        bucket_epochs = np.lib.format.open_memmap(
+            os.path.join(output_dir, name+"_epochs.npy"), mode="w+",
+            dtype=np.float64, shape=(offset,))
+
+        for level_info, level in zip(info["levels"], levels):
+            start = level_info["offset"]
+            end = start + level_info["buckets"]
+            pyramid[:, :, start:end] = level
+            bucket_epochs[start:end] = epochs[::level_info["bucket_size"]]
+
+        pyramid.flush()
+        bucket_epochs.flush()
+
+        if decimate > 1:
+            np.save(os.path.join(output_dir, name+"_decimated.npy"),
+                lowpass_decimate(data, decimate))
+            info["decimate"] = decimate
+            info["decimated_freq"] = freq / decimate
+
+        index["streams"][name] = info
+
+    with open(os.path.join(output_dir, "index.json"), "w") as f:
+        json.dump(index, f, indent=2)
+        f.write("\n")
+
+
+def load_index(pyramid_dir):
+    """ Load the index of a pyramid """
+    with open(os.path.join(pyramid_dir, "index.json")) as f:
+        return json.load(f)
+
+
+def load_level(pyramid_dir, stream, max_points):
+    """ Get the most detailed level with at most max_points buckets, e.g. the
+    width of the plot in pixels, memory mapped rather than read from disk
+
+    Returns the bucket size, the epoch each bucket starts at, and a
+    dictionary of each statistic to a (channels, buckets) array. """
+    info = load_index(pyramid_dir)["streams"][stream]
+
+    # No levels if there were no samples
+    if len(info["levels"]) == 0:
+        return 2, np.zeros(0), {stat: np.zeros((len(info["channels"]), 0),
+            dtype=np.float32) for stat in STATS}
+
+    levels = [level for level in info["levels"]
+        if level["buckets"] <= max_points]
+
+    if len(levels) == 0:
+        levels = info["levels"][-1:]
+
+    level = levels[0]
+    start = level["offset"]
+    end = start + level["buckets"]
+    pyramid = np.load(os.path.join(pyramid_dir, stream+".npy"), mmap_mode="r")
+    bucket_epochs = np.load(os.path.join(pyramid_dir, stream+"_epochs.npy"),
+        mmap_mode="r")
+
+    return level["bucket_size"], bucket_epochs[start:end], \
+        {stat: pyramid[i, :, start:end] for i, stat in enumerate(STATS)}
+
+
+def load_decimated(pyramid_dir, stream):
+    """ Get the decimated (channels, samples) signal and its sampling
+    frequency, memory mapped """
+    info = load_index(pyramid_dir)["streams"][stream]
+
+    if "decimate" not in info:
+        raise FileNotFoundError("pyramid built without --decimate")
+
+    data = np.load(os.path.join(pyramid_dir, stream+"_decimated.npy"),
+        mmap_mode="r")
+
+    return data, info["decimated_freq"]
+
+
+def plot_overview(pyramid_dir, stream, width, save=None):
+    """ Plot the min/max envelope and mean of each channel """
+    # Only import matplotlib if plotting
+    import matplotlib.pyplot as plt
+
+    channels = load_index(pyramid_dir)["streams"][stream]["channels"]
+    bucket_size, epochs, stats = load_level(pyramid_dir, stream, width)
+    t = (epochs - epochs[0]) / 3600 if len(epochs) > 0 else epochs
+
+    fig, axes = plt.subplots(nrows=len(channels), sharex=True, squeeze=False,
+        figsize=(15, 1.5*len(channels)))
+    plt.suptitle(stream+" ("+str(bucket_size)+" samples per point)")
+
+    for i, channel in enumerate(channels):
+        ax = axes[i][0]
+        ax.fill_between(t, stats["min"][i], stats["max"][i], alpha=0.3,
+            linewidth=0)
+        ax.plot(t, stats["mean"][i], linewidth=0.5)
+        ax.set_ylabel(channel)
+        ax.margins(x=0)
+
+    axes[-1][0].set_xlabel("hours")
+
+    if save is not None:
+        plt.savefig(save, dpi=100, bbox_inches="tight")
+    else:
+        plt.show()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="build a pyramid")
+    build_parser.add_argument("input", help="input.pb")
+    build_parser.add_argument("output", help="output directory")
+    build_parser.add_argument("--freq", type=float, default=50.0,
+        help="sampling frequency in Hz of accelerometers, etc.")
+    build_parser.add_argument("--decimate", type=int, default=1,
+        help="also save the signal low-pass filtered and decimated by this "
+        "factor")
+
+    plot_parser = subparsers.add_parser("plot", help="plot an overview")
+    plot_parser.add_argument("input", help="pyramid directory")
+    plot_parser.add_argument("--stream", default="accelerometer",
+        choices=STREAMS.keys())
+    plot_parser.add_argument("--width", type=int, default=2000,
+        help="max number of points to plot")
+    plot_parser.add_argument("--save", default=None,
+        help="save the figure to this file rather than showing it")
+
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.input):
+        print("Error: input does not exist:", args.input)
+        exit(1)
+
+    if args.command == "build":
+        if os.path.exists(args.output):
+            print("Error: output directory exists:", args.output)
+            exit(1)
+
+        streams = {name: decode_columns(args.input, message_type, fields)
+            for name, (message_type, fields) in STREAMS.items()}
+        build_pyramid(streams, args.output, args.freq, args.decimate)
+    else:
+        plot_overview(args.input, args.stream, args.width, args.save)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Data quality report for a sensor data file, computed in one pass over the
+file using the epoch and message type of each message (see frames.py),
+parsing only the location messages
+
+For each message type: number of messages, effective and nominal sampling
+rates, jitter, gaps, duplicate epochs, and out-of-order segments. For
+location data: the fraction of invalid fixes (see msg_to_json in
+decode_sensor_data.py).
+"""
+import os
+import json
+import argparse
+import numpy as np
+
+from frames import scan_frames
+from decoding import open_file
+from watch_data_pb2 import SensorData
+
+
+def get_type_name(message_type):
+    """ Get the MessageType enum name, if it's a known one """
+    try:
+        return SensorData.MessageType.Name(message_type)
+    except ValueError:
+        return "unknown_"+str(message_type)
+
+
+def stream_report(epochs, min_gap, gap_factor):
+    """ Compute the quality statistics of one message type's epochs, in the
+    order they were in the file
+
+    Returns the report and a list of gaps as (start epoch, end epoch). """
+    # Where it goes back in time is the start of an out-of-order segment
+    out_of_order = int(np.count_nonzero(np.diff(epochs) < 0))
+
+    epochs = np.sort(epochs)
+    dt = np.diff(epochs)
+    duration = float(epochs[-1] - epochs[0]) if len(epochs) > 0 else 0.0
+
+    # Use the typical time between samples to determine what is a gap
+    positive = dt[dt > 0]
+    median_dt = float(np.median(positive)) if len(positive) > 0 else 0.0
+    gap_threshold = max(min_gap, gap_factor*median_dt)
+    is_gap = dt > gap_threshold
+    not_gap = dt[~is_gap & (dt > 0)]
+
+    report = {
+        "messages": len(epochs),
+        "first_epoch": float(epochs[0]) if len(epochs) > 0 else None,
+        "last_epoch": float(epochs[-1]) if len(epochs) > 0 else None,
+        "duration": duration,
+        "effective_rate": (len(epochs)-1) / duration if duration > 0 else None,
+        "nominal_rate": 1 / median_dt if median_dt > 0 else None,
+        "jitter": float(np.std(not_gap)) if len(not_gap) > 0 else None,
+        "max_jitter": float(np.max(np.abs(not_gap - median_dt)))
+            if len(not_gap) > 0 else None,
+        "gap_threshold": gap_threshold,
+        "gaps": int(np.count_nonzero(is_gap)),
+        "gap_duration": float(np.sum(dt[is_gap])),
+        "longest_gap": float(np.max(dt[is_gap])) if np.any(is_gap) else 0.0,
+        "duplicate_epochs": int(np.count_nonzero(dt == 0)),
+        "out_of_order_segments": out_of_order,
+    }
+
+    gap_i = np.flatnonzero(is_gap)
+    gaps = list(zip(epochs[gap_i].tolist(), epochs[gap_i+1].tolist()))
+
+    return report, gaps
+
+
+def location_report(locations):
+    """ Get the fraction of invalid location fixes, with 0.0 meaning invalid
+    as in msg_to_json in decode_sensor_data.py """
+    if len(locations) == 0:
+        return {"messages": 0}
+
+    values = np.array([(msg.longitude, msg.latitude, msg.horiz_acc,
+        msg.altitude, msg.vert_acc) for msg in locations])
+    invalid_horizontal = np.all(values[:, 0:3] == 0.0, axis=1)
+    invalid_vertical = np.all(values[:, 3:5] == 0.0, axis=1)
+
+    return {
+        "messages": len(locations),
+        "invalid_horizontal": float(np.mean(invalid_horizontal)),
+        "invalid_vertical": float(np.mean(invalid_vertical)),
+        "invalid_either": float(np.mean(invalid_horizontal | invalid_vertical)),
+    }
+
+
+def quality_report(filename, min_gap=1.0, gap_factor=5.0):
+    """ Scan the file once, computing the report and list of gaps """
+    all_epochs = []
+    all_types = []
+    locations = []
+    total_bytes = 0
+
+    for buf, offsets, sizes, epochs, types in scan_frames(filename, SensorData):
+        all_epochs.append(epochs)
+        all_types.append(types)
+        total_bytes += int(np.sum(sizes)) + 2*len(sizes)
+
+        # Location is only ~1 Hz, so parsing these is cheap
+        for i in np.flatnonzero(types == SensorData.MESSAGE_TYPE_LOCATION):
+            locations.append(SensorData.FromString(
+                buf[offsets[i]:offsets[i]+sizes[i]]))
+
+    epochs = np.concatenate(all_epochs) if len(all_epochs) > 0 else np.zeros(0)
+    types = np.concatenate(all_types) if len(all_types) > 0 \
+        else np.zeros(0, dtype=np.int64)
+
+    report = {
+        "file": filename,
+        "bytes": total_bytes,
+        "messages": len(epochs),
+        "streams": {},
+        "location": location_report(locations),
+    }
+    gaps = []
+
+    for message_type in np.unique(types):
+        name = get_type_name(int(message_type))
+        stream, stream_gaps = stream_report(epochs[types == message_type],
+            min_gap, gap_factor)
+        report["streams"][name] = stream
+        gaps += [{"message_type": name, "start": start, "end": end,
+            "seconds": end - start} for start, end in stream_gaps]
+
+    return report, gaps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("input", help="input.pb")
+    parser.add_argument("output", nargs="?", default="-",
+        help="output.json (default: stdout)")
+    parser.add_argument("--gaps", default=None,
+        help="also write the list of gaps to this JSON file (- for stdout)")
+    parser.add_argument("--min-gap", type=float, default=1.0,
+        help="min seconds between samples to count as a gap")
+    parser.add_argument("--gap-factor", type=float, default=5.0,
+        help="min multiple of the median time between samples to count as "
+        "a gap")
+    args = parser.parse_args(argv)
+
+    if args.input != "-" and not os.path.exists(args.input):
+        print("Error: input file does not exist:", args.input)
+        exit(1)
+
+    for output_fn in [args.output, args.gaps]:
+        if output_fn not in [None, "-"] and os.path.exists(output_fn):
+            print("Error: output file exists:", output_fn)
+            exit(1)
+
+    report, gaps = quality_report(args.input, args.min_gap, args.gap_factor)
+
+    with open_file(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+    if args.gaps is not None:
+        with open_file(args.gaps, "w") as f:
+            json.dump(gaps, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
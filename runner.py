@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+Process many participants at once: find each directory of sensor_data_*.pb
+and responses_*.pb files, then merge, decode to JSON, convert to KML, and
+plot spectrograms, running as many jobs at a time as there are cores
+
+Each participant's output goes in a directory of the same relative path in
+the output directory, e.g. output/p01/sensor_data.json, with each job's
+output in output/p01/logs/. Jobs are run as subprocesses of watch.py, each
+limited to --memory MiB, and --limit caps how many of one kind run at once,
+e.g. --limit fft=2.
+
+Finished jobs are recorded in output/state.json, so rerunning after a crash
+or a failure only runs the jobs not done yet, or those whose input files
+changed. The timings and failures of each run are in output/summary.json.
+
+    ./runner.py run participants/ output/ --limit fft=2 --memory 4096
+    ./runner.py merge sensor_data.pb sensor_data_*.pb
+"""
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import argparse
+import resource
+import subprocess
+
+from cache import write_json
+
+# Run the tools through the entry point next to this file
+WATCH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "watch.py")
+
+# Kinds of jobs, in the order they're added for each participant
+KINDS = ["merge", "decode", "kml", "fft"]
+
+# How often to check whether running jobs finished, in seconds
+POLL_INTERVAL = 0.05
+
+
+class Job:
+    """ One command to run for a participant, after the jobs it depends on """
+    def __init__(self, participant, name, kind, command, inputs, outputs,
+            deps=()):
+        self.participant = participant
+        self.name = participant+"/"+name
+        self.kind = kind
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.deps = [participant+"/"+dep for dep in deps]
+
+    def signature(self):
+        """ Get the size and modification time of each input file, so a job
+        is run again if its inputs changed """
+        return [[os.path.basename(filename), os.stat(filename).st_size,
+            os.stat(filename).st_mtime_ns] for filename in self.inputs]
+
+    def remove_outputs(self):
+        """ Remove any partial output of an earlier run, since the tools don't
+        overwrite files """
+        for filename in self.outputs:
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            elif os.path.exists(filename):
+                os.remove(filename)
+
+
+def merge_files(output_filename, input_filenames):
+    """ Concatenate the input files into the output, like cat, writing to a
+    temporary file first so a crash doesn't leave a partial file """
+    tmp_filename = output_filename+".tmp"
+
+    with open(tmp_filename, "wb") as output:
+        for input_filename in input_filenames:
+            with open(input_filename, "rb") as f:
+                shutil.copyfileobj(f, output, 1 << 22)
+
+    os.replace(tmp_filename, output_filename)
+
+
+def find_participants(input_dir):
+    """ Get the relative path of each directory with sensor_data_*.pb or
+    responses_*.pb files, sorted """
+    participants = []
+
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        dirnames.sort()
+
+        if any(filename.endswith(".pb") and (filename.startswith(
+                "sensor_data_") or filename.startswith("responses_"))
+                for filename in filenames):
+            participants.append(os.path.relpath(dirpath, input_dir))
+
+    return participants
+
+
+def get_jobs(input_dir, output_dir, participant, kinds):
+    """ Get the jobs of one participant """
+    source_dir = os.path.join(input_dir, participant)
+    target_dir = os.path.join(output_dir, participant)
+    python = [sys.executable, WATCH]
+    jobs = []
+
+    for prefix, decode_command in [("sensor_data", "decode-sensor"),
+            ("responses", "decode-responses")]:
+        parts = sorted(glob.glob(os.path.join(glob.escape(source_dir),
+            prefix+"_*.pb")))
+
+        if len(parts) == 0:
+            continue
+
+        merged = os.path.join(target_dir, prefix+".pb")
+        json_filename = os.path.join(target_dir, prefix+".json")
+        merge_name = "merge-"+prefix
+
+        jobs.append(Job(participant, merge_name, "merge",
+            [sys.executable, os.path.abspath(__file__), "merge", merged]
+            + parts, parts, [merged]))
+        jobs.append(Job(participant, "decode-"+prefix, "decode",
+            python+[decode_command, merged, json_filename], [merged],
+            [json_filename], [merge_name]))
+
+        if prefix == "sensor_data":
+            kml_filename = os.path.join(target_dir, prefix+".kml")
+            plots_dir = os.path.join(target_dir, "plots")
+            jobs.append(Job(participant, "kml", "kml",
+                python+["kml", merged, kml_filename], [merged],
+                [kml_filename], [merge_name]))
+            jobs.append(Job(participant, "fft", "fft",
+                python+["fft", "--batch", "--workers", "1", "--output_dir",
+                plots_dir, merged], [merged], [plots_dir], [merge_name]))
+
+    # Keep merging if a dependent kind is selected
+    selected = set(kinds) | ({"merge"} if len(kinds) > 0 else set())
+
+    return [job for job in jobs if job.kind in selected]
+
+
+def limit_memory(memory):
+    """ Get a function to limit the address space of a subprocess to memory
+    MiB, run in the subprocess before the command """
+    def set_limit():
+        limit = memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    return set_limit if memory is not None else None
+
+
+def load_state(filename):
+    """ Load the job name: {signature, seconds} of the finished jobs """
+    try:
+        with open(filename) as f:
+            return json.load(f)["done"]
+    except (FileNotFoundError, ValueError, KeyError):
+        return {}
+
+
+def log_tail(filename, lines=5):
+    """ Get the last lines of a job's output, e.g. the error """
+    try:
+        with open(filename, errors="replace") as f:
+            return f.read().splitlines()[-lines:]
+    except FileNotFoundError:
+        return []
+
+
+class Runner:
+    """ Run jobs once the jobs they depend on are done, at most workers at a
+    time and at most limits[kind] of each kind """
+    def __init__(self, jobs, output_dir, workers, limits=None, memory=None):
+        self.jobs = jobs
+        self.output_dir = output_dir
+        self.workers = workers
+        self.limits = limits or {}
+        self.memory = memory
+        self.state_filename = os.path.join(output_dir, "state.json")
+        self.done = load_state(self.state_filename)
+        self.results = {}
+
+    def is_done(self, job):
+        """ Whether the job finished in an earlier run with the same inputs
+        and its outputs still exist """
+        return job.name in self.done and all(os.path.exists(filename)
+            for filename in job.inputs + job.outputs) \
+            and self.done[job.name]["signature"] == job.signature()
+
+    def start(self, job):
+        """ Start a job as a subprocess writing to its log file """
+        log_dir = os.path.join(self.output_dir, job.participant, "logs")
+        os.makedirs(log_dir, exist_ok=True)
+        job.remove_outputs()
+        log_filename = os.path.join(log_dir, job.name.split("/")[-1]+".log")
+
+        with open(log_filename, "w") as log:
+            process = subprocess.Popen(job.command, stdin=subprocess.DEVNULL,
+                stdout=log, stderr=subprocess.STDOUT,
+                preexec_fn=limit_memory(self.memory))
+
+        return process, log_filename, time.perf_counter()
+
+    def finish(self, job, process, log_filename, start):
+        """ Record a job that exited """
+        seconds = time.perf_counter() - start
+        self.results[job.name] = {
+            "kind": job.kind,
+            "status": "done" if process.returncode == 0 else "failed",
+            "seconds": seconds,
+            "returncode": process.returncode,
+            "log": log_filename,
+        }
+
+        if process.returncode == 0:
+            self.done[job.name] = {"signature": job.signature(),
+                "seconds": seconds}
+        else:
+            self.done.pop(job.name, None)
+            self.results[job.name]["error"] = log_tail(log_filename)
+
+        # Save after each job, so a crash loses at most the running ones
+        write_json({"done": self.done}, self.state_filename)
+
+    def can_start(self, job, running_kinds):
+        """ Whether the job's dependencies are done and there's room for
+        another of its kind """
+        return all(self.results.get(dep, {}).get("status") in ["done",
+            "resumed"] for dep in job.deps) \
+            and running_kinds.get(job.kind, 0) < self.limits.get(job.kind,
+            self.workers)
+
+    def run(self):
+        """ Run all the jobs not already done, returning the results """
+        os.makedirs(self.output_dir, exist_ok=True)
+        pending = []
+
+        for job in self.jobs:
+            # Jobs after a job that's run again must run again too
+            rerun_deps = any(self.results.get(dep, {}).get("status")
+                != "resumed" for dep in job.deps)
+
+            if not rerun_deps and self.is_done(job):
+                self.results[job.name] = {"kind": job.kind,
+                    "status": "resumed",
+                    "seconds": self.done[job.name]["seconds"]}
+            else:
+                pending.append(job)
+
+        running = {}
+
+        while len(pending) > 0 or len(running) > 0:
+            running_kinds = {}
+
+            for job, _ in running.values():
+                running_kinds[job.kind] = running_kinds.get(job.kind, 0) + 1
+
+            for job in list(pending):
+                if len(running) >= self.workers:
+                    break
+
+                failed_deps = [dep for dep in job.deps
+                    if self.results.get(dep, {}).get("status")
+                    in ["failed", "skipped"]]
+
+                if len(failed_deps) > 0:
+                    pending.remove(job)
+                    self.results[job.name] = {"kind": job.kind,
+                        "status": "skipped", "seconds": 0.0,
+                        "error": ["not run since failed: "
+                            +", ".join(failed_deps)]}
+                elif self.can_start(job, running_kinds):
+                    pending.remove(job)
+                    process, log_filename, start = self.start(job)
+                    running[process.pid] = (job, (process, log_filename,
+                        start))
+                    running_kinds[job.kind] = \
+                        running_kinds.get(job.kind, 0) + 1
+
+            time.sleep(POLL_INTERVAL)
+
+            for pid, (job, (process, log_filename, start)) in \
+                    list(running.items()):
+                if process.poll() is not None:
+                    del running[pid]
+                    self.finish(job, process, log_filename, start)
+
+        return self.results
+
+
+def summarize(results, seconds):
+    """ Get the number of jobs, seconds of each kind, and failures """
+    summary = {
+        "seconds": seconds,
+        "jobs": {status: sum(result["status"] == status
+            for result in results.values())
+            for status in ["done", "resumed", "failed", "skipped"]},
+        "kinds": {},
+        "failures": {},
+        "results": results,
+    }
+
+    for name, result in results.items():
+        if result["status"] == "done":
+            kind = summary["kinds"].setdefault(result["kind"],
+                {"jobs": 0, "seconds": 0.0, "max_seconds": 0.0})
+            kind["jobs"] += 1
+            kind["seconds"] += result["seconds"]
+            kind["max_seconds"] = max(kind["max_seconds"], result["seconds"])
+        elif result["status"] in ["failed", "skipped"]:
+            summary["failures"][name] = result["error"]
+
+    return summary
+
+
+def print_summary(summary):
+    print("Finished", summary["jobs"]["done"], "jobs in",
+        "{:.1f}".format(summary["seconds"]), "seconds,",
+        summary["jobs"]["resumed"], "already done,",
+        summary["jobs"]["failed"], "failed,",
+        summary["jobs"]["skipped"], "skipped")
+
+    for kind, info in summary["kinds"].items():
+        print("  {:8s} {:4d} jobs, {:8.1f} s total, {:8.1f} s max".format(
+            kind, info["jobs"], info["seconds"], info["max_seconds"]))
+
+    for name, error in summary["failures"].items():
+        print("Error:", name+":", " / ".join(error[-1:]), file=sys.stderr)
+
+
+def parse_limits(limits):
+    """ Parse KIND=N arguments """
+    parsed = {}
+
+    for limit in limits:
+        kind, _, number = limit.partition("=")
+
+        if kind not in KINDS or not number.isdigit() or int(number) < 1:
+            print("Error: expected --limit KIND=N with KIND one of",
+                ", ".join(KINDS)+":", limit)
+            exit(1)
+
+        parsed[kind] = int(number)
+
+    return parsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="process all participants")
+    run_parser.add_argument("input", help="directory of participant "
+        "directories")
+    run_parser.add_argument("output", help="output directory")
+    run_parser.add_argument("-j", "--workers", type=int,
+        default=os.cpu_count(), help="max jobs at a time (default: number "
+        "of cores)")
+    run_parser.add_argument("--limit", action="append", default=[],
+        help="max jobs of one kind at a time, e.g. fft=2")
+    run_parser.add_argument("--memory", type=int, default=None,
+        help="max MiB of address space of each job")
+    run_parser.add_argument("--kinds", default=",".join(KINDS[1:]),
+        help="comma-separated kinds of jobs to run (default: %(default)s, "
+        "merging as needed)")
+
+    merge_parser = subparsers.add_parser("merge",
+        help="concatenate files, e.g. sensor_data_*.pb")
+    merge_parser.add_argument("output", help="output.pb")
+    merge_parser.add_argument("inputs", nargs="+", help="input.pb files")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "merge":
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        merge_files(args.output, args.inputs)
+        return
+
+    if not os.path.isdir(args.input):
+        print("Error: input directory does not exist:", args.input)
+        exit(1)
+
+    kinds = [kind for kind in args.kinds.split(",") if kind != ""]
+
+    if any(kind not in KINDS for kind in kinds):
+        print("Error: expected --kinds of", ", ".join(KINDS)+":", args.kinds)
+        exit(1)
+
+    # Skip the output directory if it's inside the input directory
+    participants = [participant
+        for participant in find_participants(args.input)
+        if not os.path.abspath(os.path.join(args.input, participant))
+            .startswith(os.path.abspath(args.output)+os.sep)]
+
+    if len(participants) == 0:
+        print("Error: no sensor_data_*.pb or responses_*.pb files in",
+            args.input)
+        exit(1)
+
+    jobs = [job for participant in participants
+        for job in get_jobs(args.input, args.output, participant, kinds)]
+    runner = Runner(jobs, args.output, max(args.workers, 1),
+        parse_limits(args.limit), args.memory)
+
+    start = time.perf_counter()
+    results = runner.run()
+    summary = summarize(results, time.perf_counter() - start)
+    write_json(summary, os.path.join(args.output, "summary.json"))
+    print_summary(summary)
+
+    if summary["jobs"]["failed"] > 0 or summary["jobs"]["skipped"] > 0:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
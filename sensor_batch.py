@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+Convert between files of SensorData messages and files of SensorBatch
+messages, each holding up to --batch-size messages of one message type with
+each field packed (see watch-data.proto), and get NumPy arrays directly from
+the packed fields
+
+    ./sensor_batch.py encode sensor_data.pb archive.pb
+    ./sensor_batch.py decode archive.pb sensor_data.pb
+
+Both files use the same size-prefixed framing. Converting back gives the same
+messages, but grouped by message type rather than in the original order.
+Decoding sorts on epoch, keeping the order of messages with the same epoch,
+so decoding either file gives the same JSON, except that messages of
+different message types with the same epoch may be in a different order.
+"""
+import os
+import argparse
+import numpy as np
+
+from itertools import groupby
+from google.protobuf.message import DecodeError
+from google.protobuf.descriptor import FieldDescriptor
+
+from columns import get_dtype
+from decoding import DOUBLE, open_file, read_frames
+from watch_data_pb2 import SensorData, SensorBatch
+
+# Max size of a message given the 2-byte size prefix
+MAX_FRAME_SIZE = 65535
+
+# Fields with one value per message, the same names as in SensorData
+VALUE_FIELDS = [field.name for field in SensorBatch.DESCRIPTOR.fields
+    if field.name not in ["base_epoch", "epoch_deltas", "message_type"]]
+
+# Key: field, for parsing the serialized batches
+FIELDS_BY_NUMBER = SensorBatch.DESCRIPTOR.fields_by_number
+
+# Wire types of the fields of a serialized message
+WIRE_VARINT = 0
+WIRE_64BIT = 1
+WIRE_LENGTH_DELIMITED = 2
+
+
+def make_batch(messages):
+    """ Create a SensorBatch from SensorData messages of one message type """
+    bits = np.array([msg.epoch for msg in messages]).view(np.int64)
+    batch = SensorBatch(base_epoch=messages[0].epoch,
+        message_type=messages[0].message_type)
+
+    # Differences wrap around for huge jumps, and then also wrap back when
+    # added up, so the bits are always the same
+    batch.epoch_deltas.extend(np.diff(bits, prepend=bits[0]).tolist())
+
+    for name in VALUE_FIELDS:
+        values = [getattr(msg, name) for msg in messages]
+
+        # Skip if all 0, comparing the bits so we keep -0.0
+        dtype = get_dtype(SensorData, name)
+
+        if np.array(values, dtype=dtype).view(np.uint32).any():
+            getattr(batch, name).extend(values)
+
+    return batch
+
+
+def to_batches(messages, batch_size=512):
+    """ Group SensorData messages by message type into SensorBatch messages,
+    each of at most batch_size messages and small enough for the 2-byte size
+    prefix, in the order they were in within each message type """
+    messages = sorted(messages, key=lambda msg: msg.message_type)
+    batches = []
+
+    for _, group in groupby(messages, key=lambda msg: msg.message_type):
+        group = list(group)
+        chunks = [group[i:i+batch_size]
+            for i in range(0, len(group), batch_size)]
+
+        while len(chunks) > 0:
+            chunk = chunks.pop(0)
+            batch = make_batch(chunk)
+
+            # Split in half if too large, e.g. if many fields are used
+            if batch.ByteSize() > MAX_FRAME_SIZE and len(chunk) > 1:
+                half = len(chunk) // 2
+                chunks[0:0] = [chunk[:half], chunk[half:]]
+            else:
+                batches.append(batch)
+
+    return batches
+
+
+def from_batch(batch):
+    """ Get the SensorData messages back from a SensorBatch """
+    columns = get_batch_columns(batch)
+    message_type = columns.pop("message_type")
+    epochs = columns.pop("epoch").tolist()
+    fields = [name for name in VALUE_FIELDS if len(getattr(batch, name)) > 0]
+    values = [columns[name].tolist() for name in fields]
+
+    return [SensorData(epoch=epoch, message_type=message_type,
+        **dict(zip(fields, row))) for epoch, *row in zip(epochs, *values)]
+
+
+def get_epochs(base_epoch, deltas):
+    """ Undo the differences of the epochs' bits """
+    base = np.array([base_epoch]).view(np.int64)[0]
+    return (base + np.cumsum(deltas, dtype=np.int64)).view(np.float64)
+
+
+def get_batch_columns(batch, fields=None):
+    """ Get the message type, epochs, and given fields (default: all) of a
+    parsed SensorBatch as arrays, the same as from get_columns """
+    columns = {
+        "message_type": batch.message_type,
+        "epoch": get_epochs(batch.base_epoch,
+            np.array(batch.epoch_deltas, dtype=np.int64)),
+    }
+
+    for name in VALUE_FIELDS if fields is None else fields:
+        values = getattr(batch, name)
+        dtype = get_dtype(SensorData, name)
+
+        if len(values) > 0:
+            columns[name] = np.array(values, dtype=dtype)
+        else:
+            columns[name] = np.zeros(len(batch.epoch_deltas), dtype=dtype)
+
+    return columns
+
+
+def read_varint(data, pos):
+    """ Read a varint, returning it and the position after it """
+    value = 0
+    shift = 0
+
+    while True:
+        if pos >= len(data):
+            raise DecodeError("truncated varint")
+
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        pos += 1
+        shift += 7
+
+        if byte < 0x80:
+            return value, pos
+
+
+def unpack_varints(data, signed=False):
+    """ Decode packed varints all at once with NumPy, undoing the zigzag
+    encoding of sint32/sint64 if signed """
+    data = np.frombuffer(data, dtype=np.uint8)
+
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Each varint ends with a byte without the continuation bit, and its
+    # bytes are 7 bits each, least significant first
+    ends = data < 0x80
+    starts = np.flatnonzero(np.concatenate([[True], ends[:-1]]))
+    position = np.arange(len(data)) - np.repeat(starts,
+        np.diff(np.append(starts, len(data))))
+    bits = (data & 0x7f).astype(np.uint64) << (7*position).astype(np.uint64)
+    values = np.bitwise_or.reduceat(bits, starts)
+
+    if signed:
+        values = (values >> np.uint64(1)) ^ (0 - (values & np.uint64(1)))
+
+    return values.view(np.int64)
+
+
+def has_whole_values(field, data):
+    """ Whether the bytes of a packed field aren't cut off mid-value """
+    if field.type == FieldDescriptor.TYPE_FLOAT:
+        return len(data) % 4 == 0
+
+    # The last byte of a varint doesn't have the continuation bit
+    return len(data) == 0 or data[-1] < 0x80
+
+
+def parse_batch_fields(data):
+    """ Find where each field of a serialized SensorBatch is, without parsing
+    the values
+
+    Returns the base epoch, the message type, and the bytes of each packed
+    field by name, or None if not in the form we expect (e.g. repeated
+    fields not packed, or truncated), in which case the message needs to be
+    parsed, which raises DecodeError if it is invalid. """
+    base_epoch = 0.0
+    message_type = 0
+    packed = {}
+    pos = 0
+    end = len(data)
+
+    try:
+        while pos < end:
+            key, pos = read_varint(data, pos)
+            number = key >> 3
+            wire_type = key & 0x7
+
+            if number == 1 and wire_type == WIRE_64BIT and pos + 8 <= end:
+                base_epoch = DOUBLE.unpack_from(data, pos)[0]
+                pos += 8
+            elif number == 3 and wire_type == WIRE_VARINT:
+                message_type, pos = read_varint(data, pos)
+            elif number in FIELDS_BY_NUMBER \
+                    and wire_type == WIRE_LENGTH_DELIMITED:
+                size, pos = read_varint(data, pos)
+                field = FIELDS_BY_NUMBER[number]
+                part = data[pos:pos+size]
+                pos += size
+
+                if pos > end or not has_whole_values(field, part):
+                    return None
+
+                # Packed fields may be split in more than one part
+                packed[field.name] = packed.get(field.name, b"") + part
+            else:
+                return None
+    except DecodeError:
+        return None
+
+    return base_epoch, message_type, packed
+
+
+def batch_columns(data, message_types=None, fields=None):
+    """ Get the columns (see get_batch_columns) of a serialized SensorBatch,
+    converting the packed fields straight to arrays
+
+    If message_types is given, returns None for batches of other message
+    types without converting them. """
+    parsed = parse_batch_fields(data)
+
+    if parsed is None:
+        batch = SensorBatch.FromString(data)
+
+        if message_types is not None and batch.message_type not in message_types:
+            return None
+
+        return get_batch_columns(batch, fields)
+
+    base_epoch, message_type, packed = parsed
+
+    if message_types is not None and message_type not in message_types:
+        return None
+
+    epochs = get_epochs(base_epoch,
+        unpack_varints(packed.get("epoch_deltas", b""), signed=True))
+    columns = {"message_type": message_type, "epoch": epochs}
+
+    for name in VALUE_FIELDS if fields is None else fields:
+        field = SensorBatch.DESCRIPTOR.fields_by_name[name]
+        dtype = get_dtype(SensorData, name)
+
+        if name not in packed:
+            columns[name] = np.zeros(len(epochs), dtype=dtype)
+            continue
+        elif field.type == FieldDescriptor.TYPE_FLOAT:
+            values = np.frombuffer(packed[name], dtype="<f4").astype(dtype)
+        else:
+            values = unpack_varints(packed[name],
+                signed=field.type == FieldDescriptor.TYPE_SINT32).astype(dtype)
+
+        if len(values) != len(epochs):
+            raise ValueError("batch has "+str(len(values))+" values of "+name
+                +" but "+str(len(epochs))+" epochs")
+
+        columns[name] = values
+
+    return columns
+
+
+def decode_batch_columns(filename, message_type, fields):
+    """ Get the given fields of one message type from a file of SensorBatch
+    messages as arrays sorted on epoch, the same as decode_columns """
+    parts = []
+
+    with open_file(filename, "rb") as f:
+        for data in read_frames(f):
+            columns = batch_columns(data, {message_type}, fields)
+
+            if columns is not None:
+                parts.append(columns)
+
+    result = {}
+
+    for name in ["epoch"] + list(fields):
+        dtype = np.float64 if name == "epoch" else get_dtype(SensorData, name)
+        result[name] = np.concatenate([np.zeros(0, dtype=dtype)]
+            + [columns[name] for columns in parts])
+
+    # Sort since when saving to a file on the watch, they may be out of order
+    order = np.argsort(result["epoch"], kind="stable")
+
+    return {name: values[order] for name, values in result.items()}
+
+
+def write_frames(messages, f):
+    """ Write size-prefixed messages """
+    for msg in messages:
+        data = msg.SerializeToString()
+        f.write(len(data).to_bytes(2, "little") + data)
+
+
+def encode_file(input_filename, output_filename, batch_size=512):
+    """ Convert a file of SensorData messages to SensorBatch messages """
+    with open_file(input_filename, "rb") as f:
+        messages = [SensorData.FromString(data) for data in read_frames(f)]
+
+    with open_file(output_filename, "wb") as f:
+        write_frames(to_batches(messages, batch_size), f)
+
+
+def decode_file(input_filename, output_filename):
+    """ Convert a file of SensorBatch messages back to SensorData messages """
+    with open_file(input_filename, "rb") as f, \
+            open_file(output_filename, "wb") as out:
+        for data in read_frames(f):
+            write_frames(from_batch(SensorBatch.FromString(data)), out)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    encode_parser = subparsers.add_parser("encode",
+        help="SensorData to SensorBatch messages")
+    encode_parser.add_argument("input", help="input.pb, - for stdin")
+    encode_parser.add_argument("output", help="output.pb, - for stdout")
+    encode_parser.add_argument("--batch-size", type=int, default=512,
+        help="max messages per batch")
+
+    decode_parser = subparsers.add_parser("decode",
+        help="SensorBatch to SensorData messages")
+    decode_parser.add_argument("input", help="input.pb, - for stdin")
+    decode_parser.add_argument("output", help="output.pb, - for stdout")
+
+    args = parser.parse_args(argv)
+
+    if args.input != "-" and not os.path.exists(args.input):
+        print("Error: input file does not exist:", args.input)
+        exit(1)
+    if args.output != "-" and os.path.exists(args.output):
+        print("Error: output file exists:", args.output)
+        exit(1)
+
+    if args.command == "encode":
+        encode_file(args.input, args.output, args.batch_size)
+    else:
+        decode_file(args.input, args.output)
+
+
+if __name__ == "__main__":
+    main()
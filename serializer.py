@@ -0,0 +1,300 @@
+"""
+Convert protobuf messages to JSON with a function generated from the
+message's DESCRIPTOR, rather than hand-written for each field
+
+The layout (which fields go under which keys, in which nested objects, for
+each message type) and the rules for when a field is null are configuration,
+see decode_sensor_data.py. From these, one function is generated per message
+class that formats each message type with a single string formatting
+operation: the keys, enum names, and punctuation are precomputed, and the
+output is the same as json.dumps() of the equivalent dictionary.
+
+Fields not in any layout, e.g. ones just added to watch-data.proto, are
+output after the layout, named as in the .proto file, if not 0 (or ""). A
+message type without a layout, e.g. a new one, outputs the type field and all
+the fields that aren't 0 after the header. Enum values without a name, e.g.
+from a newer .proto file, are output as their number, as MessageToDict does.
+"""
+import json
+
+from json.encoder import encode_basestring_ascii
+from google.protobuf.descriptor import FieldDescriptor
+
+# Types output with str(), which for floats may need checking for nan/inf
+FLOAT_TYPES = {FieldDescriptor.CPPTYPE_FLOAT, FieldDescriptor.CPPTYPE_DOUBLE}
+
+
+def is_repeated(field):
+    """ Whether a field is repeated (newer protobuf removed field.label) """
+    if hasattr(field, "is_repeated"):
+        return field.is_repeated
+
+    return field.label == FieldDescriptor.LABEL_REPEATED
+
+
+def is_supported(field):
+    """ Whether we can output a field: not repeated, a message, or bytes """
+    return not is_repeated(field) \
+        and field.cpp_type != FieldDescriptor.CPPTYPE_MESSAGE \
+        and field.type != FieldDescriptor.TYPE_BYTES
+
+
+def json_key(key):
+    """ Get the JSON of a key, escaped for % formatting """
+    return (encode_basestring_ascii(key)+": ").replace("%", "%%")
+
+
+class Serializer:
+    """ Convert messages of one class to JSON strings
+
+    Arguments:
+     - message_class: e.g. SensorData
+     - header: [(key, field)] output first for every message
+     - layouts: {enum name of type_field: [(key, spec)]}, where spec is a
+       field name or a nested [(key, spec)] layout
+     - type_field: the field deciding which layout to use
+     - null_when_zero: {field: [fields]}, output null if those fields are
+       all 0 (or ""), only where the field is in the header or a layout
+     - enum_zero_as: {field: enum name} to output rather than the 0 value
+     - formatters: {field: function} returning the string to output
+    """
+    def __init__(self, message_class, header, layouts, type_field,
+            null_when_zero=None, enum_zero_as=None, formatters=None):
+        self.descriptor = message_class.DESCRIPTOR
+        self.header = header
+        self.layouts = layouts
+        self.type_field = type_field
+        self.null_when_zero = null_when_zero or {}
+        self.enum_zero_as = enum_zero_as or {}
+        self.formatters = formatters or {}
+
+        self.fields = self.descriptor.fields_by_name
+        self.enum_names = {name: self.get_enum_names(name)
+            for name, field in self.fields.items()
+            if field.cpp_type == FieldDescriptor.CPPTYPE_ENUM}
+
+        # Fields in the header or any layout aren't output elsewhere
+        referenced = set(self.get_fields(header)) | {type_field}
+
+        for layout in layouts.values():
+            referenced |= set(self.get_fields(layout))
+
+        supported = [field.name for field in self.descriptor.fields
+            if is_supported(field)]
+        self.extras = [name for name in supported if name not in referenced]
+        self.others = [name for name in supported
+            if name not in self.get_fields(header) and name != type_field]
+
+        # Message types without a layout still say which type they are
+        self.type_layout = [] if type_field in self.get_fields(header) \
+            else [(type_field, type_field)]
+
+        self.source = self.generate()
+        namespace = {
+            "_str": encode_basestring_ascii,
+            "_slow": self.to_json_slow,
+        }
+        namespace.update({"_enum_"+name: {number: encode_basestring_ascii(
+            enum_name) for number, enum_name in names.items()}
+            for name, names in self.enum_names.items()})
+        namespace.update({"_format_"+name: formatter
+            for name, formatter in self.formatters.items()})
+        exec(compile(self.source, "<serializer "+self.descriptor.name+">",
+            "exec"), namespace)
+
+        #: Convert one message to JSON
+        self.to_json = namespace["to_json"]
+
+    def get_enum_names(self, name):
+        """ Get the enum value number: name of a field """
+        names = {value.number: value.name
+            for value in self.fields[name].enum_type.values}
+
+        if name in self.enum_zero_as:
+            names[0] = self.enum_zero_as[name]
+
+        return names
+
+    def get_fields(self, layout):
+        """ Get the names of the fields in a layout, in order """
+        names = []
+
+        for _, spec in layout:
+            if isinstance(spec, str):
+                names.append(spec)
+            else:
+                names += self.get_fields(spec)
+
+        return names
+
+    def check_field(self, name):
+        """ Make sure the field exists and is a type we can output """
+        if name not in self.fields:
+            raise KeyError("no field "+name+" in "+self.descriptor.name)
+
+        field = self.fields[name]
+
+        if not is_supported(field):
+            raise NotImplementedError("can't output "+name+" to JSON, only "
+                "non-repeated numbers, strings, and enums")
+
+        return field
+
+    def is_default(self, name, value):
+        """ Whether a field's value is 0 (or "") """
+        return value == self.fields[name].default_value
+
+    def value_expr(self, name, null_rules=True):
+        """ Get the expression of the JSON of a field's value in the local
+        variable v_<name>, and whether it may be a float """
+        field = self.check_field(name)
+        v = "v_"+name
+
+        if name in self.formatters:
+            expr = "_str(_format_"+name+"("+v+"))"
+        elif field.cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+            expr = "_enum_"+name+".get("+v+", "+v+")"
+        elif field.cpp_type == FieldDescriptor.CPPTYPE_STRING:
+            expr = "_str("+v+")"
+        elif field.cpp_type == FieldDescriptor.CPPTYPE_BOOL:
+            expr = "(\"true\" if "+v+" else \"false\")"
+        else:
+            # str() of ints, and of floats since it is repr(), as json.dumps
+            expr = v
+
+        if null_rules and name in self.null_when_zero:
+            condition = " and ".join("v_{} == {!r}".format(other,
+                self.fields[other].default_value)
+                for other in self.null_when_zero[name])
+            expr = "(\"null\" if "+condition+" else "+expr+")"
+
+        return expr, field.cpp_type in FLOAT_TYPES \
+            and name not in self.formatters
+
+    def layout_template(self, layout, constants, args):
+        """ Get the % format string of a layout, adding the expression of
+        each field's value to args; fields in constants are output as is """
+        items = []
+
+        for key, spec in layout:
+            if isinstance(spec, str):
+                if spec in constants:
+                    value = constants[spec].replace("%", "%%")
+                else:
+                    value = "%s"
+                    args.append(self.value_expr(spec))
+
+                items.append(json_key(key)+value)
+            else:
+                items.append(json_key(key)+"{"
+                    + self.layout_template(spec, constants, args)+"}")
+
+        return ", ".join(items)
+
+    def generate_branch(self, layout, extras, constants, indent):
+        """ Get the lines of code converting a message with one layout """
+        args = []
+        template = self.layout_template(self.header + layout, constants, args)
+        used = [name for name in self.get_fields(self.header + layout)
+            if name not in constants]
+
+        # Fields the null rules depend on are needed too
+        for name in list(used):
+            used += self.null_when_zero.get(name, [])
+
+        used += extras
+
+        lines = [indent+"v_{0} = msg.{0}".format(name)
+            for name in dict.fromkeys(used)]
+        has_floats = any(is_float for _, is_float in args)
+        lines.append(indent+"s = {!r} % ({},)".format("{"+template,
+            ", ".join(expr for expr, _ in args)))
+
+        # The null rules are for the layouts, e.g. the magnetometer fields
+        # of device motion, so fields outside them are output as they are
+        for name in extras:
+            expr, is_float = self.value_expr(name, null_rules=False)
+            has_floats = has_floats or is_float
+            lines.append(indent+"if v_{} != {!r}:".format(name,
+                self.fields[name].default_value))
+            lines.append(indent+"    s += {!r} % ({},)".format(", "
+                + json_key(name)+"%s", expr))
+
+        # str() gives nan/inf for floats, which json.dumps outputs as
+        # NaN/Infinity, so then do it the slow way
+        if has_floats:
+            lines.append(indent+"if \"nan\" in s or \"inf\" in s:")
+            lines.append(indent+"    return _slow(msg)")
+
+        lines.append(indent+"return s + \"}\"")
+
+        return lines
+
+    def generate(self):
+        """ Generate the source code of the to_json(msg) function """
+        lines = ["def to_json(msg):", "    t = msg."+self.type_field]
+        type_names = {name: number
+            for number, name in self.get_enum_names(self.type_field).items()}
+
+        for type_name, layout in self.layouts.items():
+            number = type_names[type_name]
+            constants = {self.type_field: encode_basestring_ascii(
+                self.enum_names[self.type_field][number])}
+            lines.append("    if t == {}:".format(number))
+            lines += self.generate_branch(layout, self.extras, constants,
+                " "*8)
+
+        # Message types without a layout
+        lines += self.generate_branch(self.type_layout, self.others, {},
+            " "*4)
+
+        return "\n".join(lines)+"\n"
+
+    def value(self, name, msg, null_rules=True):
+        """ Get the Python value of a field to output with json.dumps """
+        field = self.fields[name]
+        value = getattr(msg, name)
+
+        if null_rules and name in self.null_when_zero and all(self.is_default(other,
+                getattr(msg, other)) for other in self.null_when_zero[name]):
+            return None
+        elif name in self.formatters:
+            return self.formatters[name](value)
+        elif field.cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+            return self.enum_names[name].get(value, value)
+        else:
+            return value
+
+    def layout_dict(self, layout, msg):
+        """ Get the dictionary of a layout """
+        return {key: self.value(spec, msg) if isinstance(spec, str)
+            else self.layout_dict(spec, msg) for key, spec in layout}
+
+    def to_dict(self, msg):
+        """ Convert one message to a dictionary, the same as to_json but
+        without the generated function """
+        type_name = self.enum_names[self.type_field].get(
+            getattr(msg, self.type_field))
+
+        if type_name in self.layouts:
+            layout = self.layouts[type_name]
+            extras = self.extras
+        else:
+            layout = self.type_layout
+            extras = self.others
+
+        data = self.layout_dict(self.header + layout, msg)
+
+        for name in extras:
+            if not self.is_default(name, getattr(msg, name)):
+                data[name] = self.value(name, msg, null_rules=False)
+
+        return data
+
+    def to_json_slow(self, msg):
+        """ Convert one message to JSON with json.dumps """
+        return json.dumps(self.to_dict(msg))
+
+    def to_json_batch(self, messages, separator=",\n"):
+        """ Convert messages to JSON, joined with the separator """
+        return separator.join(map(self.to_json, messages))
@@ -0,0 +1,105 @@
+"""
+Stream messages as NDJSON (one JSON object per line) as they are read, e.g.
+to decode in a pipe without temporary files:
+
+    cat sensor_data_*.pb | ./decode_sensor_data.py --ndjson - - | ...
+
+Output is written and flushed once per block of input read. Messages are
+either in arrival order, or sorted on epoch using a buffer of the last
+--sort-window seconds of messages, so memory use is bounded.
+"""
+import sys
+import heapq
+
+from decoding import open_file, read_frame_blocks, Deduplicator
+
+
+def stream_messages(f, message_type, order="sorted", window=60.0):
+    """ Parse messages from the file, yielding a list of them for each block
+    read, either in the order read ("arrival") or sorted on epoch ("sorted")
+
+    When sorting, a message is only yielded once we've read a message more
+    than window seconds newer, so if messages are more out of order than
+    that, they'll still be out of order. Returns the number of those. """
+    if order == "arrival":
+        for frames in read_frame_blocks(f):
+            yield [message_type.FromString(data) for data in frames]
+
+        return 0
+    elif order != "sorted":
+        raise NotImplementedError("unknown order "+order)
+
+    # Heap of (epoch, order read, message), the order read so sorting is
+    # stable and so we never compare the messages themselves
+    heap = []
+    count = 0
+    newest = float("-inf")
+    last_yielded = float("-inf")
+    late = 0
+
+    for frames in read_frame_blocks(f):
+        for data in frames:
+            msg = message_type.FromString(data)
+            heapq.heappush(heap, (msg.epoch, count, msg))
+            count += 1
+            newest = max(newest, msg.epoch)
+
+            if msg.epoch < last_yielded:
+                late += 1
+
+        ready = []
+
+        while len(heap) > 0 and heap[0][0] < newest - window:
+            ready.append(heapq.heappop(heap)[2])
+
+        if len(ready) > 0:
+            last_yielded = ready[-1].epoch
+            yield ready
+
+    ready = [heapq.heappop(heap)[2] for _ in range(len(heap))]
+
+    if len(ready) > 0:
+        yield ready
+
+    return late
+
+
+def write_ndjson(input_filename, message_type, msg_to_json_fn,
+        output_filename, order="sorted", window=60.0, dedup=False):
+    """ Decode, convert to JSON and write one object per line as we read
+
+    If dedup, drop duplicate messages, returning the number dropped. When
+    sorted, duplicates are next to each other, otherwise we look for them
+    within the last window seconds of messages. """
+    late = 0
+    deduplicator = Deduplicator(window if order == "arrival" else 0.0)
+
+    try:
+        with open_file(input_filename, "rb") as input_file, \
+                open_file(output_filename, "w") as output_file:
+            messages = stream_messages(input_file, message_type, order, window)
+
+            while True:
+                try:
+                    batch = next(messages)
+                except StopIteration as e:
+                    late = e.value
+                    break
+
+                if dedup:
+                    batch = [msg for msg in batch
+                        if not deduplicator.is_duplicate(msg.epoch, msg)]
+
+                output_file.write("".join(msg_to_json_fn(msg)+"\n"
+                    for msg in batch))
+                output_file.flush()
+    except BrokenPipeError:
+        # Whatever is reading our output exited, e.g. head, so stop quietly
+        return deduplicator.dropped
+
+    if late > 0:
+        print("Warning:", late, "messages were more than", window,
+            "seconds out of order, so are out of order in the output",
+            file=sys.stderr)
+
+    return deduplicator.dropped
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Compare one SensorData message per sample with SensorBatch messages (see
+sensor_batch.py): file size, compressed size, and how long it takes to get
+the accelerometer and device motion data as arrays
+
+Usage: ./test_batch.py sensor_data.pb [batch_size ...]
+"""
+import os
+import sys
+import time
+import gzip
+
+from functools import partial
+
+# Use the modules in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    ".."))
+
+from columns import ACCEL_FIELDS, MOTION_FIELDS, decode_columns
+from decoding import read_frames
+from sensor_batch import to_batches, write_frames, decode_batch_columns
+from watch_data_pb2 import SensorData
+
+STREAMS = [
+    (SensorData.MESSAGE_TYPE_ACCELEROMETER, ACCEL_FIELDS),
+    (SensorData.MESSAGE_TYPE_DEVICE_MOTION, MOTION_FIELDS),
+]
+
+
+def time_columns(decode_fn, filename, repeat=3):
+    """ Best time to get the arrays of each stream """
+    best = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+
+        for message_type, fields in STREAMS:
+            decode_fn(filename, message_type, fields)
+
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    return best
+
+
+def report(name, filename, messages, seconds):
+    with open(filename, "rb") as f:
+        data = f.read()
+
+    print("{:18s} {:10d} bytes ({:.1f} per message), gzip {:10d} bytes, "
+        "{:.3f} s to arrays ({:.0f} messages/s)".format(name, len(data),
+        len(data) / messages, len(gzip.compress(data)), seconds,
+        messages / seconds))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: ./test_batch.py sensor_data.pb [batch_size ...]")
+        exit(1)
+
+    input_fn = sys.argv[1]
+    batch_sizes = [int(size) for size in sys.argv[2:]] or [64, 512]
+
+    with open(input_fn, "rb") as f:
+        messages = [SensorData.FromString(data) for data in read_frames(f)]
+
+    # Without the cache, to time parsing the messages
+    report("SensorData:", input_fn, len(messages),
+        time_columns(partial(decode_columns, cache=False), input_fn))
+
+    for batch_size in batch_sizes:
+        output_fn = input_fn+".batch"+str(batch_size)
+
+        with open(output_fn, "wb") as f:
+            write_frames(to_batches(messages, batch_size), f)
+
+        report("SensorBatch "+str(batch_size)+":", output_fn, len(messages),
+            time_columns(decode_batch_columns, output_fn))
+        os.remove(output_fn)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Single entry point for all of the tools, e.g.
+
+    ./watch.py decode-sensor sensor_data.pb sensor_data.json
+    ./watch.py decode-sensor --output-dir json/ sensor_data_*.pb
+    ./watch.py fft --input sensor_data.pb
+
+Each subcommand only imports the modules it needs (e.g. matplotlib only for
+fft), so starting up is fast.
+"""
+import sys
+import argparse
+import importlib
+
+# Subcommand: (module, description, whether it uses absl flags)
+# The module must have a main(argv) function.
+COMMANDS = {
+    "decode-sensor": ("decode_sensor_data", "decode sensor data into JSON", False),
+    "decode-responses": ("decode_responses", "decode responses into JSON", False),
+    "kml": ("kml", "convert location data to KML", False),
+    "fft": ("fft", "plot spectrograms of the sensor data", True),
+    "windows": ("windows", "cut labeled windows and compute features", True),
+    "join": ("join", "as-of join of the sensor data streams", True),
+    "partition": ("partition", "decode into files by day and message type", False),
+    "pyramid": ("pyramid", "build or plot a multi-resolution overview", False),
+    "quality": ("quality", "report sampling rates, gaps, duplicates, etc.", False),
+    "ingest": ("ingest", "upload server and replay client", False),
+    "batch": ("sensor_batch", "convert to/from packed SensorBatch messages", False),
+    "location": ("location", "find stay points and trips", False),
+    "cache": ("cache", "show or clear the cache of decoded arrays", False),
+    "runner": ("runner", "process many participants, resumably", False),
+}
+
+
+def run(command, argv):
+    """ Import the module for the subcommand and run its main function """
+    module_name, _, uses_absl = COMMANDS[command]
+    module = importlib.import_module(module_name)
+    prog = sys.argv[0]+" "+command
+
+    if uses_absl:
+        from absl import app
+        app.run(module.main, argv=[prog]+argv)
+    else:
+        module.main(argv)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="subcommands:\n"+"\n".join(
+            "  {:18s}{}".format(command, description)
+            for command, (_, description, _) in COMMANDS.items()))
+    parser.add_argument("command", choices=COMMANDS.keys(), metavar="command",
+        help="subcommand to run, see below")
+    parser.add_argument("args", nargs=argparse.REMAINDER,
+        help="arguments for the subcommand, see: command --help")
+    args = parser.parse_args(argv)
+
+    run(args.command, args.args)
+
+
+if __name__ == "__main__":
+    main()
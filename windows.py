@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Cut fixed-length sliding windows of sensor data around the activity labels
+and compute per-window features, e.g. for training activity classifiers
+
+The accelerometer and device motion data are resampled onto one time grid at
+--freq Hz, so the output is dense. Output (.npz file or directory of .npy
+files) contains:
+ - windows: (windows, channels, time) sensor data
+ - features: (windows, channels, features) per-window features
+ - labels: activity label of each window
+ - epochs: start time of each window
+ - channels, feature_names: names of the channels and features
+"""
+import os
+import numpy as np
+
+from absl import app
+from absl import flags
+from concurrent.futures import ProcessPoolExecutor
+from numpy.lib.stride_tricks import sliding_window_view
+
+from columns import ACCEL_FIELDS, MOTION_FIELDS, decode_columns, get_labels, \
+    save_arrays
+from decoding import decode
+from earth import DERIVED_FIELDS, earth_columns
+from watch_data_pb2 import SensorData, PromptResponse
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("input", None, "Input sensor data protobuf file")
+flags.DEFINE_string("responses", None, "Input responses protobuf file")
+flags.DEFINE_string("output", None, "Output .npz file, or directory for .npy files")
+flags.DEFINE_float("freq", 50.0, "Sampling frequency in Hz to resample the data to")
+flags.DEFINE_float("length", 5.0, "Length of each window in seconds")
+flags.DEFINE_float("stride", 1.0, "Shift in seconds from one window to the next")
+flags.DEFINE_float("before", 60.0, "Seconds before each label to use windows from")
+flags.DEFINE_float("after", 60.0, "Seconds after each label to use windows from")
+flags.DEFINE_float("max_gap", 0.5, "Skip windows containing gaps in the data longer than this many seconds")
+flags.DEFINE_integer("bands", 8, "Number of equal-width FFT bands to compute the power of")
+flags.DEFINE_integer("workers", 1, "Number of processes to compute features in, each on a range of time")
+flags.DEFINE_boolean("earth", False, "Also add the vertical, horizontal, and total user acceleration in the earth frame as channels (see earth.py)")
+
+flags.mark_flag_as_required("input")
+flags.mark_flag_as_required("responses")
+flags.mark_flag_as_required("output")
+
+# Angles wrap around at +/- pi, so don't interpolate straight across them
+ANGLE_FIELDS = ["roll", "pitch", "yaw"]
+
+
+def resample(columns, fields, grid):
+    """ Linearly interpolate the fields onto the time grid, (channels, time) """
+    data = np.empty((len(fields), len(grid)), dtype=np.float32)
+
+    for i, field in enumerate(fields):
+        if field in ANGLE_FIELDS:
+            values = np.interp(grid, columns["epoch"], np.unwrap(columns[field]))
+            data[i] = (values + np.pi) % (2*np.pi) - np.pi
+        else:
+            data[i] = np.interp(grid, columns["epoch"], columns[field])
+
+    return data
+
+
+def gap_mask(epochs, grid, max_gap):
+    """ True for each time on the grid that is not within max_gap seconds of
+    both the previous and next sample """
+    if len(epochs) == 0:
+        return np.ones(len(grid), dtype=bool)
+
+    i = np.searchsorted(epochs, grid)
+    prev_epoch = epochs[np.maximum(i-1, 0)]
+    next_epoch = epochs[np.minimum(i, len(epochs)-1)]
+
+    return (grid < epochs[0]) | (grid > epochs[-1]) \
+        | (next_epoch - prev_epoch > max_gap)
+
+
+def get_sensor_data(accel, motion, freq, max_gap, earth=False):
+    """ Resample accelerometer and device motion columns (see get_columns)
+    onto one time grid, optionally with the derived channels of earth.py
+
+    Returns the grid of epochs, data (channels, time), channel names, and
+    whether each time on the grid is in a gap of one of the streams. """
+    motion = dict(motion)
+    motion_fields = MOTION_FIELDS
+
+    if earth:
+        # Rotate before resampling, since the angles are interpolated
+        motion.update(earth_columns(motion))
+        motion_fields = MOTION_FIELDS + DERIVED_FIELDS
+    # Each stream is interpolated, which needs at least one sample
+    if len(accel["epoch"]) == 0:
+        raise ValueError("no accelerometer data")
+    if len(motion["epoch"]) == 0:
+        raise ValueError("no device motion data")
+
+    epochs = np.concatenate([accel["epoch"], motion["epoch"]])
+
+    grid = np.arange(epochs.min(), epochs.max(), 1/freq)
+    data = np.concatenate([
+        resample(accel, ACCEL_FIELDS, grid),
+        resample(motion, motion_fields, grid),
+    ])
+    gaps = gap_mask(accel["epoch"], grid, max_gap) \
+        | gap_mask(motion["epoch"], grid, max_gap)
+
+    return grid, data, ACCEL_FIELDS + motion_fields, gaps
+
+
+def sliding_windows(data, length, stride):
+    """ View of (channels, time) data as (windows, channels, length) windows
+    starting every stride samples, without copying """
+    windows = sliding_window_view(data, length, axis=-1)[:, ::stride]
+    return windows.transpose(1, 0, 2)
+
+
+def label_windows(starts, ends, label_epochs, before, after):
+    """ Get the index of the label for each window, or -1 if the window isn't
+    entirely within before/after seconds of the nearest label """
+    if len(label_epochs) == 0:
+        return np.full(len(starts), -1)
+
+    # Nearest label to the center of each window
+    centers = (starts + ends) / 2
+    i = np.searchsorted(label_epochs, centers)
+    prev_i = np.maximum(i-1, 0)
+    next_i = np.minimum(i, len(label_epochs)-1)
+    nearest = np.where(
+        centers - label_epochs[prev_i] <= label_epochs[next_i] - centers,
+        prev_i, next_i)
+
+    inside = (starts >= label_epochs[nearest] - before) \
+        & (ends <= label_epochs[nearest] + after)
+
+    return np.where(inside, nearest, -1)
+
+
+def get_feature_names(bands):
+    """ Names of the features computed by compute_features """
+    return ["mean", "variance", "energy"] \
+        + ["band_power_"+str(i) for i in range(bands)]
+
+
+def compute_features(windows, freq, bands):
+    """ Compute features of each channel of (windows, channels, time) data,
+    giving (windows, channels, features) """
+    length = windows.shape[-1]
+    windows = windows.astype(np.float64)
+    mean = windows.mean(axis=-1)
+    variance = windows.var(axis=-1)
+    energy = np.square(windows).mean(axis=-1)
+
+    # Power in equal-width frequency bands from 0 to the Nyquist frequency
+    power = np.square(np.abs(np.fft.rfft(windows - mean[..., None], axis=-1)))
+    power /= length
+    band = np.fft.rfftfreq(length, 1/freq) / (freq/2) * bands
+    band = np.minimum(band.astype(np.int64), bands-1)
+    band_power = power @ (band[:, None] == np.arange(bands)).astype(np.float64)
+
+    features = np.concatenate([
+        mean[..., None], variance[..., None], energy[..., None], band_power,
+    ], axis=-1)
+
+    return features.astype(np.float32)
+
+
+def compute_features_parallel(windows, freq, bands, workers):
+    """ Compute features, splitting the windows by time range across worker
+    processes """
+    if workers <= 1 or len(windows) < workers:
+        return compute_features(windows, freq, bands)
+
+    shards = np.array_split(windows, workers)
+
+    with ProcessPoolExecutor(workers) as executor:
+        results = executor.map(compute_features, shards,
+            [freq]*len(shards), [bands]*len(shards))
+        return np.concatenate(list(results))
+
+
+def make_windows(accel, motion, response_messages):
+    """ Get the labeled windows and their features """
+    grid, data, channels, gaps = get_sensor_data(accel, motion, FLAGS.freq,
+        FLAGS.max_gap, FLAGS.earth)
+    label_epochs, labels = get_labels(response_messages)
+
+    length = int(round(FLAGS.length * FLAGS.freq))
+    stride = max(int(round(FLAGS.stride * FLAGS.freq)), 1)
+
+    if len(grid) < length:
+        raise ValueError("less data than one window")
+
+    windows = sliding_windows(data, length, stride)
+    starts = grid[:len(grid)-length+1:stride]
+    ends = starts + (length-1) / FLAGS.freq
+
+    # Skip windows with any gap in them, i.e. gap count differs at the ends
+    gap_count = np.concatenate([[0], np.cumsum(gaps)])
+    start_i = np.arange(0, len(grid)-length+1, stride)
+    has_gap = gap_count[start_i+length] - gap_count[start_i] > 0
+
+    label_i = label_windows(starts, ends, label_epochs, FLAGS.before,
+        FLAGS.after)
+    keep = (label_i != -1) & ~has_gap
+
+    # Only now copy the windows we keep out of the strided view
+    windows = windows[keep]
+    features = compute_features_parallel(windows, FLAGS.freq, FLAGS.bands,
+        FLAGS.workers)
+
+    return {
+        "windows": windows,
+        "features": features,
+        "labels": labels[label_i[keep]],
+        "epochs": starts[keep],
+        "channels": np.array(channels),
+        "feature_names": np.array(get_feature_names(FLAGS.bands)),
+    }
+
+
+def main(argv):
+    if os.path.exists(FLAGS.output):
+        print("Error: output exists:", FLAGS.output)
+        exit(1)
+
+    accel = decode_columns(FLAGS.input, SensorData.MESSAGE_TYPE_ACCELEROMETER,
+        ACCEL_FIELDS)
+    motion = decode_columns(FLAGS.input, SensorData.MESSAGE_TYPE_DEVICE_MOTION,
+        MOTION_FIELDS)
+
+    try:
+        arrays = make_windows(accel, motion,
+            decode(FLAGS.responses, PromptResponse))
+    except ValueError as e:
+        print("Error:", e)
+        exit(1)
+
+    save_arrays(arrays, FLAGS.output)
+
+
+if __name__ == "__main__":
+    app.run(main)